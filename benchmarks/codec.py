@@ -0,0 +1,82 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Compares the per message JSON work of the previous consume path (payload decoded twice, stdlib encoder)
+# with the codec based path (payload decoded once, fastest available encoder).
+# Run from the repository root: python benchmarks/codec.py
+
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from operator_lib.util import codec
+
+MESSAGE = json.dumps({
+    "device_id": "urn:infai:ses:device:2c1b7f38-5a8e-4a5e-9bd2-0a3b1d0c5a11",
+    "service_id": "urn:infai:ses:service:0e6a3c04-3b1e-4b8c-8ad3-8c6f0a4c8b22",
+    "value": {
+        "root": {
+            "energy": {"value": 1234.5678, "unit": "kWh"},
+            "power": {"value": 42.17, "unit": "W"},
+            "time": "2024-03-01T12:34:56.789Z"
+        }
+    }
+}).encode()
+
+RESULT = {"energy_consumption": 12.345, "timestamp": "2024-03-01T12:34:56.789Z", "initial_phase": ""}
+
+
+def previous_path():
+    message = json.loads(MESSAGE)
+    json.loads(MESSAGE).get("device_id")
+    json.dumps({
+        "pipeline_id": "pipeline",
+        "operator_id": "operator",
+        "analytics": RESULT,
+        "time": "{}Z".format(datetime.datetime.utcnow().isoformat())
+    })
+    return message
+
+
+def codec_path():
+    message = codec.loads(MESSAGE)
+    message.get("device_id")
+    codec.dumps({
+        "pipeline_id": "pipeline",
+        "operator_id": "operator",
+        "analytics": RESULT,
+        "time": "{}Z".format(datetime.datetime.utcnow().isoformat())
+    })
+    return message
+
+
+def measure(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+if __name__ == "__main__":
+    number = 100000
+    repeat = 5
+    previous = measure(previous_path, number, repeat)
+    current = measure(codec_path, number, repeat)
+    print(f"codec: {codec.codec_name}")
+    print(f"previous path: {previous:.2f} us/msg")
+    print(f"codec path:    {current:.2f} us/msg")
+    print(f"saving:        {previous - current:.2f} us/msg ({(1 - current / previous) * 100:.1f} %)")
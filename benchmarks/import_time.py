@@ -0,0 +1,77 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Measures the cumulative import time of a module in fresh interpreters via python -X importtime and fails if the
+# median exceeds the budget or if any of the modules that must be loaded lazily were imported.
+# Run from the repository root: python benchmarks/import_time.py [--module operator_lib.operator_lib] [--budget-ms 250]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+LAZY_MODULES = ("pandas", "numpy", "kazoo", "mf_lib", "mlflow", "model_trainer_client", "prometheus_client")
+
+
+def measure(module):
+    # returns cumulative import time of the module in ms and the names of all imported top level packages
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.getcwd(), os.environ.get("PYTHONPATH")))))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        env=env,
+        check=True
+    )
+    total = None
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        name = name.strip()
+        packages.add(name.split(".")[0])
+        if name == module:
+            total = int(cumulative) / 1000
+    return total, packages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="operator_lib.operator_lib")
+    parser.add_argument("--budget-ms", type=float, default=250)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    times = list()
+    packages = set()
+    for _ in range(args.runs):
+        total, imported = measure(args.module)
+        times.append(total)
+        packages |= imported
+    median = statistics.median(times)
+    print(f"{args.module}: median {median:.1f} ms, min {min(times):.1f} ms, max {max(times):.1f} ms over {args.runs} runs")
+    eager = sorted(packages.intersection(LAZY_MODULES))
+    failed = False
+    if eager:
+        print(f"FAIL: eagerly imported {', '.join(eager)}")
+        failed = True
+    if median > args.budget_ms:
+        print(f"FAIL: exceeds budget of {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
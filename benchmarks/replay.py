@@ -0,0 +1,72 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Replays recorded (JSONL, one message value per line) or generated messages through one or more operators without
+# Kafka and reports throughput, per message latency and per stage durations.
+# Run from the repository root, the operator module must be importable from the working directory:
+# python benchmarks/replay.py my_operator:Operator --config config.json --generate 100000
+# python benchmarks/replay.py my_operator:Operator other_operator:Operator --config config.json --input messages.jsonl
+
+import argparse
+import importlib
+import json
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+
+from operator_lib.util import OperatorConfig, PreFilter
+from operator_lib.util.replay import replay, read_jsonl, generate_messages
+
+
+def load_operator_class(spec: str):
+    module, _, name = spec.partition(":")
+    return getattr(importlib.import_module(module), name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("operators", nargs="+", help="operator classes as module:Class")
+    parser.add_argument("--config", required=True, help="operator config JSON file, same content as the CONFIG variable")
+    parser.add_argument("--input", help="JSONL file with one message value per line")
+    parser.add_argument("--generate", type=int, default=10000, help="number of generated messages if no input is given")
+    parser.add_argument("--allocations", action="store_true", help="trace allocations per stage, slows down processing")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--executor-workers", type=int, default=0)
+    parser.add_argument("--prefilter", action="store_true", help="reject messages not matching any filter before decoding")
+    args = parser.parse_args()
+    with open(args.config) as file:
+        config_json = json.load(file)
+    operator_config = OperatorConfig(config_json)
+    if args.input:
+        messages = read_jsonl(args.input, topic=operator_config.inputTopics[0].name)
+    else:
+        messages = generate_messages(operator_config, args.generate)
+    for spec in args.operators:
+        operator_class = load_operator_class(spec)
+        report = replay(
+            operator_class(),
+            operator_config,
+            messages,
+            allocations=args.allocations,
+            config=operator_class.configType(config_json.get("config", {})),
+            batch_size=args.batch_size,
+            batch_linger=0,
+            executor_workers=args.executor_workers,
+            prefilter=PreFilter.from_input_topics(operator_config.inputTopics, "replay") if args.prefilter else None
+        )
+        print(f"== {spec}")
+        print(report.format())
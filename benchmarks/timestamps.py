@@ -0,0 +1,67 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+# Compares the per record timestamp handling of the previous path (naive local datetime from the consume loop,
+# converted to a UTC pandas Timestamp and formatted via pandas) with the pandas free paths.
+# Run from the repository root: python benchmarks/timestamps.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.getcwd())
+
+from operator_lib.util.timestamps import todatetime, timestamp_to_str
+from operator_lib.util.op_base import TIMESTAMP_DATETIME, TIMESTAMP_UTC, TIMESTAMP_EPOCH_MS, get_timestamp_converter
+
+KAFKA_TS = 1709296496789
+
+to_datetime = get_timestamp_converter(TIMESTAMP_DATETIME)
+to_utc = get_timestamp_converter(TIMESTAMP_UTC)
+to_epoch_ms = get_timestamp_converter(TIMESTAMP_EPOCH_MS)
+
+
+def previous_timestamp_to_str(timestamp):
+    if "." not in timestamp.tz_localize(None).isoformat():
+        return timestamp.tz_localize(None).isoformat()+".000Z"
+    else:
+        return timestamp.tz_localize(None).isoformat()+"Z"
+
+
+def previous_path():
+    return previous_timestamp_to_str(todatetime(to_datetime(KAFKA_TS)))
+
+
+def utc_path():
+    return timestamp_to_str(to_utc(KAFKA_TS))
+
+
+def epoch_ms_path():
+    return to_epoch_ms(KAFKA_TS)
+
+
+def measure(func, number, repeat):
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+if __name__ == "__main__":
+    number = 20000
+    repeat = 5
+    previous = measure(previous_path, number, repeat)
+    print(f"previous path (datetime -> pandas -> str): {previous:.2f} us/record")
+    for name, func in (("utc datetime -> str", utc_path), ("epoch ms", epoch_ms_path)):
+        current = measure(func, number, repeat)
+        print(f"{name}: {current:.2f} us/record ({previous / current:.0f}x faster)")
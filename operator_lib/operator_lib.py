@@ -15,19 +15,25 @@
 """
 
 import operator_lib.util as util
+from operator_lib.util.worker import Worker
+from operator_lib.util.op_base import on_commit
 import json
+import typing
 import confluent_kafka
 import cncr_wdg
 import signal
-import prometheus_client 
+import os
+import tempfile
+import functools
 
 class OperatorLib:
     def __init__(
         self, 
-        operator: util.OperatorBase, 
+        operator: typing.Union[util.OperatorBase, util.AsyncOperatorBase], 
         name: str = "OperatorLib", 
         git_info_file="git_commit",
-        result_error_handler=None
+        result_error_handler=None,
+        delivery_error_handler=None
     ):
         util.print_init(name=name, git_info_file=git_info_file)
         dep_config = util.DeploymentConfig()
@@ -38,6 +44,7 @@ class OperatorLib:
         util.logger.debug(f"deployment config: {dep_config}")
         util.logger.debug(f"operator config: {opr_config}")
         filter_handler = util.create_filter_handler(opr_config.inputTopics, dep_config.pipeline_id, operator.selectors)
+        prefilter = util.PreFilter.from_input_topics(opr_config.inputTopics, dep_config.pipeline_id) if dep_config.consumer_prefilter else None
         if dep_config.config_bootstrap_servers is None:
             util.logger.info(f"Using Zookeeper for kafka broker lookup: {dep_config.zk_quorum}")
             kafka_brokers = ",".join(util.get_kafka_brokers(zk_hosts=dep_config.zk_quorum, zk_path=dep_config.zk_brokers_path))
@@ -61,35 +68,101 @@ class OperatorLib:
             kafka_producer_config = {
                 'bootstrap.servers': dep_config.config_bootstrap_servers,
             }
+        if dep_config.consumer_manual_commit:
+            kafka_consumer_config["enable.auto.commit"] = False
+            kafka_consumer_config["on_commit"] = on_commit
+        elif dep_config.executor_workers > 1 or isinstance(operator, util.AsyncOperatorBase):
+            kafka_consumer_config["enable.auto.offset.store"] = False
+        kafka_producer_config["linger.ms"] = dep_config.producer_linger_ms
+        kafka_producer_config["batch.num.messages"] = dep_config.producer_batch_num_messages
+        kafka_producer_config["batch.size"] = dep_config.producer_batch_size
+        kafka_producer_config["compression.type"] = dep_config.producer_compression_type
+        kafka_producer_config["queue.buffering.max.messages"] = dep_config.producer_queue_max_messages
         if dep_config.metrics:
             util.logger.info(f"Launching with metrics server on port {dep_config.metrics_port}")
+            import prometheus_client, prometheus_client.values, prometheus_client.multiprocess
+            registry = prometheus_client.REGISTRY
+            if dep_config.workers > 1:
+                # all workers write their samples to a shared directory, which is collected by the server of this process
+                if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+                    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="prometheus_")
+                prometheus_client.values.ValueClass = prometheus_client.values.get_value_class()
+                registry = prometheus_client.CollectorRegistry()
+                prometheus_client.multiprocess.MultiProcessCollector(registry)
             kafka_consumer_config["statistics.interval.ms"] = 30000
             kafka_consumer_config["stats_cb"] = self.__consumer_stats
             kafka_producer_config["statistics.interval.ms"] = 30000
             kafka_producer_config["stats_cb"] = self.__producer_stats
-            self.__kafka_consumer_consumer_fetch_manager_metrics_records_consumed_total = prometheus_client.Gauge('kafka_consumer_consumer_fetch_manager_metrics_records_consumed_total', 'The total number of records consumed kafka.consumer:name=null,type=consumer-fetch-manager-metrics,attribute=records-consumed-total', ['client_id', 'topic'])
-            self.__kafka_consumer_consumer_fetch_manager_metrics_bytes_consumed_total = prometheus_client.Gauge('kafka_consumer_consumer_fetch_manager_metrics_bytes_consumed_total', 'The total number of bytes consumed kafka.consumer:name=null,type=consumer-fetch-manager-metrics,attribute=bytes-consumed-total', ['client_id', 'topic'])
-            self.__kafka_producer_producer_topic_metrics_record_send_total = prometheus_client.Gauge('kafka_producer_producer_metrics_record_send_total', 'The total number of records sent. kafka.producer:name=null,type=producer-metrics,attribute=record-send-total', ['client_id'])
-            self.__kafka_producer_producer_topic_metrics_byte_total = prometheus_client.Gauge('kafka_producer_producer_topic_metrics_byte_total', 'The total number of bytes sent for a topic. kafka.producer:name=null,type=producer-topic-metrics,attribute=byte-total', ['client_id', 'topic'])
-            prometheus_client.start_http_server(dep_config.metrics_port)
+            self.__kafka_consumer_consumer_fetch_manager_metrics_records_consumed_total = prometheus_client.Gauge('kafka_consumer_consumer_fetch_manager_metrics_records_consumed_total', 'The total number of records consumed kafka.consumer:name=null,type=consumer-fetch-manager-metrics,attribute=records-consumed-total', ['client_id', 'topic'], multiprocess_mode='liveall')
+            self.__kafka_consumer_consumer_fetch_manager_metrics_bytes_consumed_total = prometheus_client.Gauge('kafka_consumer_consumer_fetch_manager_metrics_bytes_consumed_total', 'The total number of bytes consumed kafka.consumer:name=null,type=consumer-fetch-manager-metrics,attribute=bytes-consumed-total', ['client_id', 'topic'], multiprocess_mode='liveall')
+            self.__kafka_producer_producer_topic_metrics_record_send_total = prometheus_client.Gauge('kafka_producer_producer_metrics_record_send_total', 'The total number of records sent. kafka.producer:name=null,type=producer-metrics,attribute=record-send-total', ['client_id'], multiprocess_mode='liveall')
+            self.__kafka_producer_producer_topic_metrics_byte_total = prometheus_client.Gauge('kafka_producer_producer_topic_metrics_byte_total', 'The total number of bytes sent for a topic. kafka.producer:name=null,type=producer-topic-metrics,attribute=byte-total', ['client_id', 'topic'], multiprocess_mode='liveall')
+            prometheus_client.start_http_server(dep_config.metrics_port, registry=registry)
 
         util.logger.debug(f"kafka consumer config: {kafka_consumer_config}")
         util.logger.debug(f"kafka producer config: {kafka_producer_config}")
-        kafka_consumer = confluent_kafka.Consumer(kafka_consumer_config, logger=util.logger)
-        kafka_producer = confluent_kafka.Producer(kafka_producer_config, logger=util.logger)
         typed_config = operator.configType({})
         if "config" in config_json:
             typed_config = operator.configType(config_json['config'])
-        operator.init(
+        self.__operator = operator
+        self.__kafka_consumer_config = kafka_consumer_config
+        self.__kafka_producer_config = kafka_producer_config
+        self.__filter_handler = filter_handler
+        self.__prefilter = prefilter
+        self.__typed_config = typed_config
+        self.__result_error_handler = result_error_handler
+        self.__delivery_error_handler = delivery_error_handler
+        self.__metrics = None
+        if dep_config.workers > 1:
+            self.__run_workers(dep_config.workers)
+        else:
+            self.__run()
+
+    def __run(self, number: int = 0):
+        dep_config = self.__dep_config
+        operator = self.__operator
+        if dep_config.metrics:
+            # created per process, values of forked workers must not share the files of the parent
+            self.__metrics = util.OperatorMetrics(sample_rate=dep_config.metrics_sample_rate)
+        run_timings = None
+        if dep_config.profiler:
+            # every worker serves its own profiler on the next port
+            run_timings = util.RunTimings()
+            util.ProfilerServer(port=dep_config.profiler_port + number, run_timings=run_timings).start()
+        kafka_consumer = confluent_kafka.Consumer(self.__kafka_consumer_config, logger=util.logger)
+        kafka_producer = confluent_kafka.Producer(self.__kafka_producer_config, logger=util.logger)
+        init_kwargs = dict(
             kafka_consumer=kafka_consumer,
             kafka_producer=kafka_producer,
-            filter_handler=filter_handler,
+            filter_handler=self.__filter_handler,
             output_topic=dep_config.output,
             pipeline_id=dep_config.pipeline_id,
             operator_id=dep_config.operator_id,
-            config=typed_config,
-            result_error_handler=result_error_handler
+            poll_timeout=dep_config.consumer_poll_timeout_ms / 1000,
+            config=self.__typed_config,
+            result_error_handler=self.__result_error_handler,
+            delivery_error_handler=self.__delivery_error_handler,
+            manual_commit=dep_config.consumer_manual_commit,
+            commit_records=dep_config.consumer_commit_interval_records,
+            commit_interval=dep_config.consumer_commit_interval_ms / 1000,
+            producer_queue_size=dep_config.producer_queue_max_messages,
+            high_watermark=dep_config.backpressure_high_watermark,
+            low_watermark=dep_config.backpressure_low_watermark,
+            output_partitioning=dep_config.output_partitioning,
+            output_coalesce=dep_config.output_coalesce,
+            output_coalesce_linger=dep_config.output_coalesce_linger_ms / 1000,
+            metrics=self.__metrics,
+            run_timings=run_timings,
+            prefilter=self.__prefilter
         )
+        if isinstance(operator, util.AsyncOperatorBase):
+            init_kwargs["max_in_flight"] = dep_config.async_max_in_flight
+        else:
+            init_kwargs["batch_size"] = dep_config.consumer_batch_size
+            init_kwargs["batch_linger"] = dep_config.consumer_batch_linger_ms / 1000
+            init_kwargs["executor_workers"] = dep_config.executor_workers
+            init_kwargs["executor_queue_size"] = dep_config.executor_queue_size
+        operator.init(**init_kwargs)
         watchdog = cncr_wdg.Watchdog(
             monitor_callables=[operator.is_alive],
             shutdown_callables=[operator.stop],
@@ -101,6 +174,27 @@ class OperatorLib:
         operator.start()
         watchdog.join()
 
+    def __run_workers(self, count: int):
+        # Every worker gets a forked copy of the operator and its own consumer and producer.
+        # Workers share the consumer group, so kafka spreads the partitions across them.
+        util.logger.info(f"Launching {count} workers")
+        on_death = None
+        if self.__dep_config.metrics:
+            import prometheus_client.multiprocess
+            on_death = prometheus_client.multiprocess.mark_process_dead
+        workers = [Worker(number=n, target=functools.partial(self.__run, n), on_death=on_death) for n in range(count)]
+        for worker in workers:
+            worker.start()
+        watchdog = cncr_wdg.Watchdog(
+            monitor_callables=[worker.is_alive for worker in workers],
+            shutdown_callables=[worker.stop for worker in workers],
+            join_callables=[worker.join for worker in workers],
+            shutdown_signals=[signal.SIGTERM, signal.SIGINT, signal.SIGABRT],
+            logger=util.logger
+        )
+        watchdog.start(delay=5)
+        watchdog.join()
+
     def __consumer_stats(self, stats_json_str):
         stats_json = json.loads(stats_json_str)
         client_id = self.__dep_config.config_application_id+'_'+stats_json['client_id']
@@ -112,13 +206,17 @@ class OperatorLib:
             for p, d in d['partitions'].items():
                 rxmsgs = rxmsgs + d['rxmsgs']
                 rx_bytes = rx_bytes + d['rxbytes']
+                # partition -1 holds messages not assigned to a partition yet, lag is -1 if unknown
+                if self.__metrics and p != "-1" and d['consumer_lag'] >= 0:
+                    self.__metrics.consumer_lag.labels(client_id=client_id, topic=topic, partition=p).set(d['consumer_lag'])
             self.__kafka_consumer_consumer_fetch_manager_metrics_records_consumed_total.labels(client_id=client_id, topic=topic).set(rxmsgs)
             self.__kafka_consumer_consumer_fetch_manager_metrics_bytes_consumed_total.labels(client_id=client_id, topic=topic).set(rx_bytes)
 
     def __producer_stats(self, stats_json_str):
-        stats_json = json.loads(stats_json_str)
         stats_json = json.loads(stats_json_str)
         client_id = self.__dep_config.config_application_id+'_'+stats_json['client_id']
+        if self.__metrics:
+            self.__metrics.producer_queue_depth.labels(client_id=client_id).set(stats_json['msg_cnt'])
         self.__kafka_producer_producer_topic_metrics_record_send_total.labels(client_id=client_id,).set(stats_json['txmsgs'])
         self.__kafka_producer_producer_topic_metrics_byte_total.labels(client_id=client_id, topic="").set(stats_json['tx_bytes'])
         for topic, d in stats_json['topics'].items():
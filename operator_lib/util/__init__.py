@@ -18,18 +18,44 @@ from .config import *
 from .logger import *
 from .model import *
 from .op_base import *
+from .async_op_base import *
 from .init_phase import *
-from .timestamps import *
-from .start_time import *
+from .state_store import *
+from .metrics import *
+from .prefilter import *
+import importlib
 import math
-import kazoo.client
 import json
 import typing
 import hashlib
+import weakref
 
-import mf_lib
 from copy import deepcopy
 
+# Names of submodules that are expensive to import (pandas, numpy, http.server), these are only imported on first access (PEP 562).
+LAZY_ATTRIBUTES = {
+    name: module for module, names in (
+        (".timestamps", ("todatetime", "todatetime_many", "timestamp_to_str", "get_ts_format_from_str", "FormatDetector")),
+        (".start_time", ("setup_operator_starttime",)),
+        (".windows", ("WindowStats", "WindowEngine", "WINDOW_TUMBLING", "WINDOW_SLIDING", "WINDOW_SESSION")),
+        (".device_state", ("DeviceStateTable", "DeviceState")),
+        (".profiler", ("StackSampler", "RunTimings", "ProfilerServer")),
+    ) for name in names
+}
+
+
+def __getattr__(name):
+    module = LAZY_ATTRIBUTES.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(LAZY_ATTRIBUTES))
+
 def print_init(name, git_info_file):
     lines = list()
     l_len = len(name)
@@ -52,6 +78,7 @@ def print_init(name, git_info_file):
 
 
 def get_kafka_brokers(zk_hosts: str, zk_path: str):
+    import kazoo.client
     zk_client = kazoo.client.KazooClient(hosts=zk_hosts)
     zk_client.start()
     brokers = list()
@@ -143,8 +170,20 @@ def gen_filter(input_topic, pipeline_id: str, selectors=None):
     filter["id"] = hash_list(items)
     return filter
 
+# selector name per filter ID of every filter handler created by create_filter_handler
+FILTER_SELECTORS: "weakref.WeakKeyDictionary[typing.Any, typing.Dict[str, str]]" = weakref.WeakKeyDictionary()
+
+def get_filter_selectors(filter_handler) -> typing.Optional[typing.Dict[str, str]]:
+    # None if the filter handler was not created by create_filter_handler
+    try:
+        return FILTER_SELECTORS.get(filter_handler)
+    except TypeError:
+        return None
+
 def create_filter_handler(input_topics, pipeline_id, selectors):
+    import mf_lib
     filter_handler = mf_lib.FilterHandler()
+    filter_selectors = dict()
 
     for input_topic_tmp in input_topics:
         # filterValue can be a list, e.g. when device group with the same service is used as input
@@ -154,6 +193,13 @@ def create_filter_handler(input_topics, pipeline_id, selectors):
             input_topic.filterValue = filter_value
             msg_filter = gen_filter(input_topic=input_topic, selectors=selectors, pipeline_id=pipeline_id)
             filter_handler.add_filter(msg_filter)
+            filter_selectors[msg_filter["id"]] = msg_filter["args"]["selector"]
             print(f"added filter: {msg_filter} for filterValue: {input_topic.filterValue}")
-    
-    return filter_handler
\ No newline at end of file
+    try:
+        FILTER_SELECTORS[filter_handler] = filter_selectors
+    except TypeError:
+        # not weakly referenceable, filter IDs are resolved on first use instead
+        pass
+    return filter_handler
+# star imports skip names that are resolved by __getattr__, so every public name is listed, lazy ones included
+__all__ = tuple(name for name in globals() if not name.startswith("_")) + tuple(LAZY_ATTRIBUTES)
@@ -0,0 +1,312 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("AsyncOperatorBase",)
+
+from .logger import logger
+from .model import Config, Selector
+from .offsets import OffsetCommitter
+from .output import OutputProducer
+from .flow import FlowControl, AdaptivePollTimeout, PAUSED_WAIT
+from .prefilter import PreFilter
+from .metrics import OperatorMetrics, StageTimer, STAGE_POLL, STAGE_DECODE
+from .op_base import SelectorDispatcher, TIMESTAMP_DATETIME, get_timestamp, get_timestamp_converter, on_assign, on_revoke, on_lost
+from . import codec
+import confluent_kafka
+import asyncio
+import inspect
+import typing
+import datetime
+import time
+
+if typing.TYPE_CHECKING:
+    import mf_lib
+    from .profiler import RunTimings
+
+
+class AsyncOperatorBase:
+    """
+    Variant of OperatorBase for operators that await I/O in run, e.g. requests to model servers or databases.
+    Messages are processed concurrently up to max_in_flight, messages of the same device are processed in order.
+    Partitions are paused while the limit is reached and resumed once half of the in-flight messages are done.
+    """
+    configType = Config # Subclasses may override this with a subclass of Config.
+    config = configType({})
+    selectors: typing.List[Selector] = [] # Subclasses should fill these.
+    timestampType = TIMESTAMP_DATETIME # Subclasses may override this to receive timestamps as TIMESTAMP_UTC or TIMESTAMP_EPOCH_MS.
+
+    def __new__(cls, *args, **kwargs):
+        obj = super(AsyncOperatorBase, cls).__new__(cls)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__convert_timestamp", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__kafka_consumer", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__filter_handler", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__dispatcher", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__output", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__offsets", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__manual_commit", False)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__pipeline_id", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__operator_id", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__poll_timeout", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__producer_watermarks", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__prefilter", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__max_in_flight", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__device_locks", dict())
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__handle_result_error", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__handle_delivery_error", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__metrics", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__run_timings", None)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__stop", False)
+        setattr(obj, f"_{AsyncOperatorBase.__name__}__stopped", False)
+        return obj
+
+    def __result_error(self, ex, message, device_id):
+        if self.__handle_result_error:
+            self.__handle_result_error(ex, message, self.produce, device_id)
+
+    def __undelivered(self, offsets):
+        logger.error(f"results of {len(offsets)} messages were not delivered, stopping so that these are consumed again after a restart")
+        self.__stop = True
+
+    def __delivery_error(self, ex, value):
+        if self.__handle_delivery_error:
+            self.__handle_delivery_error(ex, value, self.produce)
+
+    async def __call_run(self, message, device_id, timestamp: datetime.datetime):
+        run_results = list()
+        timings = self.__run_timings
+        for selector, handler, data in self.__dispatcher.iter_matches(message, device_id):
+            start = time.perf_counter() if timings is not None and timings.active else None
+            run_result = handler(
+                selector=selector,
+                data=data,
+                device_id=device_id,
+                timestamp=timestamp,
+            )
+            if inspect.isawaitable(run_result):
+                run_result = await run_result
+            if start is not None:
+                timings.add(selector, time.perf_counter() - start)
+            if run_result is not None:
+                if isinstance(run_result, list):
+                    run_results += run_result
+                else:
+                    run_results.append(run_result)
+        return run_results
+
+    async def __process(self, message, device_id, timestamp: datetime.datetime, offset):
+        device_lock = self.__device_locks.get(device_id)
+        if device_lock is None:
+            device_lock = [asyncio.Lock(), 0]
+            self.__device_locks[device_id] = device_lock
+        device_lock[1] += 1
+        try:
+            async with device_lock[0]:
+                self.__output.produce_results(await self.__call_run(message, device_id, timestamp), [offset], device_id)
+        except Exception as ex:
+            logger.exception(ex)
+            self.__stop = True
+        finally:
+            device_lock[1] -= 1
+            if device_lock[1] == 0:
+                del self.__device_locks[device_id]
+
+    def __route(self, msg_obj, in_flight: typing.Set[asyncio.Task], timer: typing.Optional[StageTimer]):
+        if not msg_obj.error():
+            if self.__prefilter and not self.__prefilter.accept(msg_obj.value()):
+                # the message can not match any filter, its offset is done right away
+                self.__offsets.done([self.__offsets.track(msg_obj)])
+                if self.__metrics:
+                    self.__metrics.prefiltered += 1
+                return
+            timestamp = get_timestamp(msg_obj, self.__convert_timestamp)
+            message = codec.loads(msg_obj.value())
+            if timer:
+                timer.lap(STAGE_DECODE)
+            if self.__metrics:
+                self.__metrics.consumed += 1
+            device_id = message.get('device_id')
+            offset = self.__offsets.track(msg_obj)
+            task = asyncio.ensure_future(self.__process(message, device_id, timestamp, offset))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        else:
+            raise confluent_kafka.KafkaException(msg_obj.error())
+
+    async def __loop(self):
+        loop = asyncio.get_running_loop()
+        in_flight: typing.Set[asyncio.Task] = set()
+        poll_timeout = AdaptivePollTimeout(maximum=self.__poll_timeout)
+        flow = FlowControl(self.__kafka_consumer)
+        flow.watch("messages in flight", in_flight.__len__, self.__max_in_flight, self.__max_in_flight // 2)
+        flow.watch("producer queue", self.__output.queue_depth, *self.__producer_watermarks)
+        while not self.__stop:
+            try:
+                paused = flow.update()
+                if paused:
+                    # let tasks progress, delivery reports are waited for below if nothing is in flight
+                    if in_flight:
+                        await asyncio.wait(in_flight, timeout=self.__poll_timeout, return_when=asyncio.FIRST_COMPLETED)
+                else:
+                    # the consumer is only used from this coroutine, poll runs in a thread so tasks can progress meanwhile
+                    # tasks interleave, so only polling and decoding are timed for sampled messages
+                    timer = self.__metrics.sample() if self.__metrics else None
+                    msg_obj = await loop.run_in_executor(None, self.__kafka_consumer.poll, poll_timeout.value)
+                    poll_timeout.update(msg_obj is not None)
+                    if timer:
+                        timer.lap(STAGE_POLL)
+                    if msg_obj:
+                        self.__route(msg_obj, in_flight, timer)
+                self.__output.poll(timeout=PAUSED_WAIT if paused and not in_flight else 0)
+                self.__offsets.handle()
+            except Exception as ex:
+                logger.exception(ex)
+                self.__stop = True
+        try:
+            if in_flight:
+                await asyncio.wait(in_flight)
+            self.__output.flush()
+            if self.__metrics:
+                self.__metrics.publish()
+            self.__offsets.handle(force=True)
+        except Exception as ex:
+            logger.exception(ex)
+
+    def init(
+        self,
+        kafka_consumer: confluent_kafka.Consumer,
+        kafka_producer: confluent_kafka.Producer,
+        filter_handler: "mf_lib.FilterHandler",
+        output_topic: str,
+        pipeline_id: str,
+        operator_id: str,
+        poll_timeout: float = 1.0,
+        config: Config = Config({}),
+        result_error_handler = None,
+        max_in_flight: int = 100,
+        manual_commit: bool = False,
+        commit_records: int = 1000,
+        commit_interval: float = 5.0,
+        producer_queue_size: int = 100000,
+        high_watermark: float = 0.8,
+        low_watermark: float = 0.5,
+        output_partitioning: str = "operator_id",
+        output_coalesce: int = 1,
+        output_coalesce_linger: float = 0.1,
+        metrics: typing.Optional[OperatorMetrics] = None,
+        run_timings: typing.Optional["RunTimings"] = None,
+        prefilter: typing.Optional[PreFilter] = None,
+        delivery_error_handler = None
+    ):
+        self.__kafka_consumer = kafka_consumer
+        self.__filter_handler = filter_handler
+        self.__dispatcher = SelectorDispatcher(
+            filter_handler=filter_handler,
+            selectors=self.selectors,
+            operator=self,
+            default_handler=self.run,
+            on_error=self.__result_error
+        )
+        self.__pipeline_id = pipeline_id
+        self.__operator_id = operator_id
+        self.__poll_timeout = poll_timeout
+        self.__convert_timestamp = get_timestamp_converter(self.timestampType)
+        self.__max_in_flight = max_in_flight
+        self.__producer_watermarks = (int(producer_queue_size * high_watermark), int(producer_queue_size * low_watermark))
+        self.__manual_commit = manual_commit
+        # messages complete out of order, offsets are always tracked
+        self.__offsets = OffsetCommitter(
+            kafka_consumer=kafka_consumer,
+            manual_commit=manual_commit,
+            commit_records=commit_records,
+            commit_interval=commit_interval
+        )
+        self.__output = OutputProducer(
+            kafka_producer=kafka_producer,
+            output_topic=output_topic,
+            pipeline_id=pipeline_id,
+            operator_id=operator_id,
+            on_delivery_error=self.__delivery_error,
+            on_done=self.__offsets.done,
+            on_undelivered=self.__undelivered,
+            wait_for_delivery=manual_commit,
+            partitioning=output_partitioning,
+            coalesce=output_coalesce,
+            coalesce_linger=output_coalesce_linger,
+            metrics=metrics
+        )
+        self.__metrics = metrics
+        self.__run_timings = run_timings
+        self.__prefilter = prefilter if prefilter and prefilter.enabled else None
+        self.__handle_result_error = result_error_handler
+        self.__handle_delivery_error = delivery_error_handler
+        self.config = config
+
+    def get_pipeline_id(self) -> str:
+        return self.__pipeline_id
+
+    def get_operator_id(self) -> str:
+        return self.__operator_id
+
+    def __on_revoke(self, consumer, partitions):
+        on_revoke(consumer, partitions)
+        # results of done messages are delivered first, so their offsets can be committed before the partitions move
+        if self.__manual_commit:
+            self.__output.flush()
+        self.__offsets.revoke(partitions)
+
+    def __on_lost(self, consumer, partitions):
+        on_lost(consumer, partitions)
+        self.__offsets.lose(partitions)
+
+    def start(self):
+        sources = self.__filter_handler.get_sources()
+        if sources:
+            self.__kafka_consumer.subscribe(
+                sources,
+                on_assign=on_assign,
+                on_revoke=self.__on_revoke,
+                on_lost=self.__on_lost
+            )
+        else:
+            raise RuntimeError("no sources")
+        try:
+            asyncio.run(self.__loop())
+        finally:
+            self.__stopped = True
+
+    def stop(self):
+        self.__stop = True
+
+    def is_alive(self) -> bool:
+        return not self.__stopped
+
+    def produce(self, value, device_id: typing.Optional[str] = None):
+        """
+        Produces a result outside of run, e.g. from a result or delivery error handler.
+        :param device_id: ID of the device the result belongs to, used as key if output is partitioned by device ID.
+        """
+        self.__output.produce(value, device_id=device_id)
+
+    async def run(self, data: typing.Dict[str, typing.Any], selector: str, device_id: str, timestamp: datetime.datetime):
+        """
+        Subclasses must override this method, unless all selectors name a handler method with the same signature.
+        :param data: Dictionary containing data extracted from a message.
+        :param selector: Name of a selector identifying the extracted data.
+        :param device_id: ID of the device the message originates from
+        :param timestamp: Kafka stored message timestamp, type depends on timestampType.
+        :return: Result data or None.
+        """
+        pass
@@ -0,0 +1,89 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("loads", "dumps", "codec_name")
+
+import json
+
+# Prefer the fastest JSON library available, fall back to the standard library.
+# dumps always returns bytes so results can be handed to the producer or spliced into other payloads directly.
+
+
+def _json_loads(data):
+    return json.loads(data)
+
+
+def _json_dumps(obj) -> bytes:
+    return json.dumps(obj).encode()
+
+
+try:
+    import orjson
+
+    _ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. NaN or Infinity, which the standard library accepts
+            return _json_loads(data)
+
+    def dumps(obj) -> bytes:
+        try:
+            return orjson.dumps(obj, option=_ORJSON_OPTIONS)
+        except TypeError:
+            return _json_dumps(obj)
+
+    codec_name = "orjson"
+except ImportError:
+    try:
+        import msgspec
+
+        _msgspec_decoder = msgspec.json.Decoder()
+        _msgspec_encoder = msgspec.json.Encoder()
+
+        def loads(data):
+            try:
+                return _msgspec_decoder.decode(data)
+            except msgspec.DecodeError:
+                return _json_loads(data)
+
+        def dumps(obj) -> bytes:
+            try:
+                return _msgspec_encoder.encode(obj)
+            except (TypeError, msgspec.EncodeError):
+                return _json_dumps(obj)
+
+        codec_name = "msgspec"
+    except ImportError:
+        try:
+            import ujson
+
+            def loads(data):
+                return ujson.loads(data)
+
+            def dumps(obj) -> bytes:
+                try:
+                    return ujson.dumps(obj, ensure_ascii=False).encode()
+                except (TypeError, OverflowError):
+                    return _json_dumps(obj)
+
+            codec_name = "ujson"
+        except ImportError:
+            loads = _json_loads
+            dumps = _json_dumps
+            codec_name = "json"
@@ -33,4 +33,28 @@ class DeploymentConfig(sevm.Config):
     zk_brokers_path = "/brokers/ids"
     metrics = False
     metrics_port = 5555
+    metrics_sample_rate = 0.01
+    profiler = False
+    profiler_port = 5556
+    workers = 1
+    producer_linger_ms = 5
+    producer_batch_num_messages = 10000
+    producer_batch_size = 1000000
+    producer_queue_max_messages = 100000
+    backpressure_high_watermark = 0.8
+    backpressure_low_watermark = 0.5
+    consumer_poll_timeout_ms = 1000
+    producer_compression_type = "none"
+    output_partitioning = "operator_id"
+    output_coalesce = 1
+    output_coalesce_linger_ms = 100
+    executor_workers = 0
+    executor_queue_size = 1000
+    async_max_in_flight = 100
+    consumer_manual_commit = False
+    consumer_commit_interval_records = 1000
+    consumer_commit_interval_ms = 5000
+    consumer_batch_size = 1
+    consumer_batch_linger_ms = 1000
+    consumer_prefilter = True
 
@@ -0,0 +1,188 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("DeviceStateTable", "DeviceState")
+
+from .persistence import load, save
+from .logger import logger
+import sys
+import time
+import typing
+
+import numpy as np
+
+
+class DeviceState:
+    # view on one row of a DeviceStateTable, fields are added as properties per table
+    # a view must not be kept after its device was removed or evicted, the row may be reused by another device
+    __slots__ = ("_columns", "_index", "device_id")
+
+    def __init__(self, columns, index, device_id):
+        self._columns = columns
+        self._index = index
+        self.device_id = device_id
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={column[self._index].item()!r}" for name, column in self._columns.items())
+        return f"{self.__class__.__name__}(device_id={self.device_id!r}, {fields})"
+
+
+def field_property(name):
+    def getter(self):
+        return self._columns[name][self._index].item()
+
+    def setter(self, value):
+        self._columns[name][self._index] = value
+
+    return property(getter, setter)
+
+
+class DeviceStateTable:
+    """
+    Fixed schema numeric state per device ID, stored column wise in numpy arrays.
+    Device IDs are interned and mapped to rows, rows of removed devices are reused.
+    Devices not accessed within ttl seconds are evicted, snapshots are stored via util.persistence.
+    """
+
+    def __init__(
+        self,
+        fields: typing.Dict[str, typing.Tuple[typing.Any, typing.Any]],
+        ttl: typing.Optional[float] = None,
+        capacity: int = 1024,
+        data_path: typing.Optional[str] = None,
+        snapshot_name: str = "device_state.pickle"
+    ):
+        """
+        :param fields: Field names mapped to (dtype, default), e.g. {"count": (np.int64, 0), "last": (np.float64, np.nan)}.
+        :param ttl: Seconds after which an idle device is evicted, None disables eviction.
+        :param data_path: Directory for snapshots, restore() loads the last snapshot from there.
+        """
+        self.fields = dict(fields)
+        self.ttl = ttl
+        self.data_path = data_path
+        self.snapshot_name = snapshot_name
+        self.__view_class = type("DeviceState", (DeviceState,), {"__slots__": (), **{name: field_property(name) for name in self.fields}})
+        self.__columns = {name: np.full(capacity, default, dtype=dtype) for name, (dtype, default) in self.fields.items()}
+        self.__last_seen = np.zeros(capacity, dtype=np.float64)
+        self.__index: typing.Dict[str, int] = dict()
+        self.__device_ids: typing.List[typing.Optional[str]] = [None] * capacity
+        self.__free = list(range(capacity - 1, -1, -1))
+        self.__last_eviction = time.monotonic()
+
+    def __grow(self):
+        capacity = len(self.__last_seen)
+        for name, (dtype, default) in self.fields.items():
+            self.__columns[name] = np.concatenate((self.__columns[name], np.full(capacity, default, dtype=dtype)))
+        self.__last_seen = np.concatenate((self.__last_seen, np.zeros(capacity, dtype=np.float64)))
+        self.__device_ids.extend([None] * capacity)
+        self.__free.extend(range(capacity * 2 - 1, capacity - 1, -1))
+
+    def __reset(self, index):
+        for name, (_, default) in self.fields.items():
+            self.__columns[name][index] = default
+
+    def get(self, device_id: str) -> DeviceState:
+        """
+        Returns the state of the device, a new row with default values is created for unknown devices.
+        """
+        if self.ttl is not None and time.monotonic() - self.__last_eviction >= self.ttl:
+            self.evict()
+        index = self.__index.get(device_id)
+        if index is None:
+            if not self.__free:
+                self.__grow()
+            index = self.__free.pop()
+            device_id = sys.intern(device_id)
+            self.__index[device_id] = index
+            self.__device_ids[index] = device_id
+        self.__last_seen[index] = time.time()
+        return self.__view_class(self.__columns, index, device_id)
+
+    __getitem__ = get
+
+    def __contains__(self, device_id):
+        return device_id in self.__index
+
+    def __len__(self):
+        return len(self.__index)
+
+    def __iter__(self):
+        return iter(list(self.__index))
+
+    def remove(self, device_id: str):
+        index = self.__index.pop(device_id, None)
+        if index is None:
+            return
+        self.__reset(index)
+        self.__device_ids[index] = None
+        self.__free.append(index)
+
+    def evict(self, now: typing.Optional[float] = None) -> int:
+        """
+        Removes all devices idle for longer than ttl.
+        :return: Number of evicted devices.
+        """
+        self.__last_eviction = time.monotonic()
+        if self.ttl is None:
+            return 0
+        now = time.time() if now is None else now
+        expired = [self.__device_ids[index] for index in np.flatnonzero(self.__last_seen < now - self.ttl) if self.__device_ids[index] is not None]
+        for device_id in expired:
+            self.remove(device_id)
+        if expired:
+            logger.debug(f"evicted {len(expired)} idle devices")
+        return len(expired)
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Returns the values of a field for all devices in the order of device_ids().
+        """
+        return self.__columns[name][list(self.__index.values())]
+
+    def device_ids(self) -> typing.List[str]:
+        return list(self.__index)
+
+    def snapshot(self):
+        rows = list(self.__index.values())
+        save(self.data_path, self.snapshot_name, {
+            "device_ids": list(self.__index),
+            "last_seen": self.__last_seen[rows],
+            "columns": {name: column[rows] for name, column in self.__columns.items()}
+        })
+
+    def restore(self) -> int:
+        """
+        Loads the last snapshot, replacing the current state. Fields missing in the snapshot keep their defaults.
+        :return: Number of restored devices.
+        """
+        data = load(self.data_path, self.snapshot_name)
+        if not data:
+            return 0
+        for device_id in list(self.__index):
+            self.remove(device_id)
+        count = len(data["device_ids"])
+        while len(self.__free) < count:
+            self.__grow()
+        rows = [self.__free.pop() for _ in range(count)]
+        for device_id, index in zip(data["device_ids"], rows):
+            device_id = sys.intern(device_id)
+            self.__index[device_id] = index
+            self.__device_ids[index] = device_id
+        self.__last_seen[rows] = data["last_seen"]
+        for name, values in data["columns"].items():
+            if name in self.__columns:
+                self.__columns[name][rows] = values
+        return count
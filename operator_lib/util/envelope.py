@@ -0,0 +1,46 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("Envelope",)
+
+from . import codec
+import datetime
+import time
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class Envelope:
+    """
+    Serializes results into the operator output format.
+    The constant pipeline and operator IDs are encoded once, the time field is regenerated at most once per millisecond.
+    """
+
+    def __init__(self, pipeline_id: str, operator_id: str):
+        self.__prefix = codec.dumps({"pipeline_id": pipeline_id, "operator_id": operator_id})[:-1] + b',"analytics":'
+        self.__time = (None, None)
+
+    def __get_time_suffix(self) -> bytes:
+        now_ms = time.time_ns() // 1000000
+        time_ms, suffix = self.__time
+        if now_ms != time_ms:
+            ts = (EPOCH + datetime.timedelta(milliseconds=now_ms)).isoformat(timespec="milliseconds")
+            suffix = f',"time":"{ts}Z"}}'.encode()
+            self.__time = (now_ms, suffix)
+        return suffix
+
+    def encode(self, value) -> bytes:
+        return b"".join((self.__prefix, codec.dumps(value), self.__get_time_suffix()))
@@ -0,0 +1,65 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("ShardedExecutor",)
+
+from .logger import logger
+import queue
+import threading
+import typing
+
+
+class ShardedExecutor:
+    """
+    Thread pool with one queue per thread. Tasks submitted with the same key always run on the same thread,
+    so they are executed in submission order while tasks with different keys run in parallel.
+    """
+
+    def __init__(self, workers: int, queue_size: int, on_error: typing.Callable[[Exception], None]):
+        self.__queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.__on_error = on_error
+        self.__threads = [
+            threading.Thread(target=self.__work, args=(q,), name=f"executor-{n}", daemon=True)
+            for n, q in enumerate(self.__queues)
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    def __work(self, q: queue.Queue):
+        while True:
+            task = q.get()
+            if task is None:
+                break
+            func, args = task
+            try:
+                func(*args)
+            except Exception as ex:
+                self.__on_error(ex)
+
+    def submit(self, key, func: typing.Callable, *args):
+        # blocks if the queue of the shard is full
+        self.__queues[hash(key) % len(self.__queues)].put((func, args))
+
+    def pending(self) -> int:
+        return sum(q.qsize() for q in self.__queues)
+
+    def shutdown(self):
+        # already queued tasks are processed before the threads exit
+        for q in self.__queues:
+            q.put(None)
+        for thread in self.__threads:
+            thread.join()
+        logger.debug("executor stopped")
@@ -0,0 +1,85 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("FlowControl", "AdaptivePollTimeout")
+
+from .logger import logger
+import confluent_kafka
+import typing
+
+PAUSED_WAIT = 0.05 # seconds to wait for delivery reports per loop iteration while consumption is paused
+
+
+class FlowControl:
+    """
+    Pauses the assigned partitions once any watched load reaches its high watermark and resumes them once all loads
+    are at or below their low watermarks. While paused, partitions assigned in the meantime are paused on every update.
+    Must be updated from the consumer thread.
+    """
+
+    def __init__(self, kafka_consumer: confluent_kafka.Consumer):
+        self.__kafka_consumer = kafka_consumer
+        self.__watches: typing.List[typing.Tuple[str, typing.Callable[[], int], int, int]] = list()
+        self.__paused = False
+
+    def watch(self, name: str, load: typing.Callable[[], int], high: int, low: int):
+        """
+        :param load: Returns the current load, e.g. the number of queued records.
+        """
+        high = max(high, 1)
+        self.__watches.append((name, load, high, max(min(low, high - 1), 0)))
+
+    @property
+    def paused(self) -> bool:
+        return self.__paused
+
+    def update(self) -> bool:
+        """
+        :return: True if consumption is paused.
+        """
+        if not self.__paused:
+            for name, load, high, _ in self.__watches:
+                current = load()
+                if current >= high:
+                    self.__kafka_consumer.pause(self.__kafka_consumer.assignment())
+                    self.__paused = True
+                    logger.debug(f"paused consumption, {name} at {current}")
+                    break
+        elif all(load() <= low for _, load, _, low in self.__watches):
+            # the current assignment, partitions may have been reassigned meanwhile
+            self.__kafka_consumer.resume(self.__kafka_consumer.assignment())
+            self.__paused = False
+            logger.debug("resumed consumption")
+        else:
+            # partitions assigned by a rebalance while paused are not paused yet, pausing is idempotent
+            self.__kafka_consumer.pause(self.__kafka_consumer.assignment())
+        return self.__paused
+
+
+class AdaptivePollTimeout:
+    # zero while messages arrive, doubles from minimum up to maximum with every empty poll
+    __slots__ = ("value", "minimum", "maximum")
+
+    def __init__(self, maximum: float, minimum: float = 0.001):
+        self.value = 0.0
+        self.minimum = min(minimum, maximum)
+        self.maximum = maximum
+
+    def update(self, received: bool):
+        if received:
+            self.value = 0.0
+        else:
+            self.value = min(max(self.value * 2, self.minimum), self.maximum)
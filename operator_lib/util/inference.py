@@ -0,0 +1,101 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("InferenceBatcher",)
+
+from .logger import logger
+import concurrent.futures
+import queue
+import threading
+import time
+import typing
+
+import pandas as pd
+
+
+class InferenceBatcher:
+    """
+    Collects feature rows from run calls and predicts them with a single model.predict call per batch.
+    A batch is predicted once it holds max_batch_size rows or its oldest row waited max_delay_ms.
+    Futures are resolved in submission order.
+    Waiting for a future in a synchronous run blocks the consumer thread for up to max_delay_ms, so the batcher pays
+    off with executor workers, AsyncOperatorBase (asyncio.wrap_future) or run_batch.
+    """
+
+    def __init__(self, get_model: typing.Callable, max_batch_size: int = 64, max_delay_ms: float = 10):
+        """
+        :param get_model: Returns the model to use for the next batch, e.g. ModelHolder.get.
+        """
+        self.__get_model = get_model
+        self.__max_batch_size = max_batch_size
+        self.__max_delay = max_delay_ms / 1000
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, name="inference-batcher", daemon=True)
+        self.__thread.start()
+
+    def submit(self, row: typing.Dict[str, typing.Any]) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.__queue.put((row, future, time.monotonic()))
+        return future
+
+    def stop(self):
+        # rows submitted before are still predicted
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __run(self):
+        stop = False
+        while not stop:
+            item = self.__queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[2] + self.__max_delay
+            while len(batch) < self.__max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.__queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.__predict(batch)
+
+    def __predict(self, batch):
+        batch = [(row, future) for row, future, _ in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        rows, futures = zip(*batch)
+        try:
+            predictions = self.__get_model().predict(pd.DataFrame(list(rows)))
+            if isinstance(predictions, (pd.DataFrame, pd.Series)):
+                predictions = [predictions.iloc[i] for i in range(len(predictions))]
+            else:
+                predictions = list(predictions)
+            # checked before resolving any future, a short result would leave some of them waiting forever
+            if len(predictions) != len(futures):
+                raise ValueError(f"model returned {len(predictions)} predictions for {len(futures)} rows")
+            for future, prediction in zip(futures, predictions):
+                future.set_result(prediction)
+        except Exception as ex:
+            logger.error(f"batch prediction failed: {ex}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(ex)
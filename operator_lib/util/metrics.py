@@ -0,0 +1,121 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("OperatorMetrics", "StageTimer")
+
+import time
+import typing
+
+STAGE_POLL = "poll" # waiting for a message in consumer.poll or consumer.consume
+STAGE_QUEUE = "queue" # waiting in the queue of an executor worker
+STAGE_DECODE = "decode" # json decoding of the message value
+STAGE_MATCH = "match" # filter matching and data extraction
+STAGE_SERIALIZE = "serialize" # wrapping and encoding a result
+STAGE_PRODUCE = "produce" # handing a record to the producer queue
+STAGE_FLUSH = "flush" # serving delivery reports and flushing the producer
+
+STAGES = (STAGE_POLL, STAGE_QUEUE, STAGE_DECODE, STAGE_MATCH, STAGE_SERIALIZE, STAGE_PRODUCE, STAGE_FLUSH)
+
+BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class StageTimer:
+    # times consecutive stages of one sampled message, every lap observes the time since the previous lap
+    __slots__ = ("__metrics", "__last")
+
+    def __init__(self, metrics: "OperatorMetrics"):
+        self.__metrics = metrics
+        self.__last = time.perf_counter()
+
+    def restart(self):
+        self.__last = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.__metrics.observe(stage, now - self.__last)
+        self.__last = now
+
+    def lap_run(self, selector: str):
+        now = time.perf_counter()
+        self.__metrics.observe_run(selector, now - self.__last)
+        self.__last = now
+
+
+class OperatorMetrics:
+    """
+    Per-stage latency histograms and record counters of the operator loop.
+    Only every n-th loop iteration is timed (sample_rate = 1/n) and counters are accumulated in plain integers and
+    handed to prometheus on sampled iterations, which keeps the overhead per message to a few integer operations.
+    Counters must only be updated from the consumer thread, delivery reports are served there as well.
+    """
+
+    def __init__(self, sample_rate: float = 0.01, registry=None):
+        import prometheus_client
+        registry = registry or prometheus_client.REGISTRY
+        self.__every = max(int(round(1 / sample_rate)), 1) if sample_rate > 0 else 0
+        self.__count = 0
+        self.__stage_duration = prometheus_client.Histogram('operator_stage_duration_seconds', 'Duration of the stages of processing a message, sampled', ['stage'], buckets=BUCKETS, registry=registry)
+        self.__run_duration = prometheus_client.Histogram('operator_run_duration_seconds', 'Duration of run calls per selector, sampled', ['selector'], buckets=BUCKETS, registry=registry)
+        self.__records_consumed = prometheus_client.Counter('operator_records_consumed', 'Number of consumed records', registry=registry)
+        self.__records_delivered = prometheus_client.Counter('operator_records_delivered', 'Number of delivered output records', registry=registry)
+        self.__delivery_errors = prometheus_client.Counter('operator_delivery_errors', 'Number of failed output record deliveries', registry=registry)
+        self.__records_prefiltered = prometheus_client.Counter('operator_records_prefiltered', 'Number of records rejected by the prefilter without decoding', registry=registry)
+        self.consumer_lag = prometheus_client.Gauge('operator_consumer_lag', 'Consumer lag per partition as reported by librdkafka', ['client_id', 'topic', 'partition'], multiprocess_mode='liveall', registry=registry)
+        self.producer_queue_depth = prometheus_client.Gauge('operator_producer_queue_depth', 'Number of messages in the producer queue as reported by librdkafka', ['client_id'], multiprocess_mode='liveall', registry=registry)
+        self.__stages = {stage: self.__stage_duration.labels(stage=stage) for stage in STAGES}
+        self.__selectors = dict()
+        self.consumed = 0
+        self.delivered = 0
+        self.delivery_errors = 0
+        self.prefiltered = 0
+
+    def sample(self) -> typing.Optional[StageTimer]:
+        """
+        Called once per loop iteration.
+        :return: A timer if this iteration is sampled, otherwise None.
+        """
+        if not self.__every:
+            return None
+        self.__count += 1
+        if self.__count < self.__every:
+            return None
+        self.__count = 0
+        self.publish()
+        return StageTimer(self)
+
+    def publish(self):
+        # hands accumulated counts to prometheus
+        if self.consumed:
+            self.__records_consumed.inc(self.consumed)
+            self.consumed = 0
+        if self.delivered:
+            self.__records_delivered.inc(self.delivered)
+            self.delivered = 0
+        if self.delivery_errors:
+            self.__delivery_errors.inc(self.delivery_errors)
+            self.delivery_errors = 0
+        if self.prefiltered:
+            self.__records_prefiltered.inc(self.prefiltered)
+            self.prefiltered = 0
+
+    def observe(self, stage: str, duration: float):
+        self.__stages[stage].observe(duration)
+
+    def observe_run(self, selector: str, duration: float):
+        child = self.__selectors.get(selector)
+        if child is None:
+            child = self.__selectors[selector] = self.__run_duration.labels(selector=selector)
+        child.observe(duration)
@@ -1,15 +1,126 @@
 import threading
-import time 
-
-import pandas as pd
-import mlflow
-from model_trainer_client.trainer import TrainerClient
+import time
+import os
+import shutil
+import hashlib
+import functools
 
 from .persistence import save, load
 
+# pandas, mlflow, model_trainer_client and prometheus_client are imported on first use to keep imports of this module cheap
+
 JOB_ID_FILENAME = "training_job_id.pickle"
-  
+MODEL_CACHE_DIR = "models"
+
+@functools.lru_cache(maxsize=None)
+def get_model_gauges():
+    # load and warm-up duration gauges, created once on first use
+    import prometheus_client
+    return (
+        prometheus_client.Gauge('operator_model_load_duration_seconds', 'Duration of the last model load', multiprocess_mode='liveall'),
+        prometheus_client.Gauge('operator_model_warmup_duration_seconds', 'Duration of the last model warm-up', multiprocess_mode='liveall')
+    )
+
+class ModelHolder():
+    # Holds the active model. A new model is loaded and warmed up with a sample batch by the calling (background)
+    # thread, the active model is only replaced afterwards by a single reference swap.
+    # Readers should fetch the model once per run call via get() and use that reference throughout.
+
+    def __init__(self, logger, warmup_data=None, on_swap=None):
+        self.logger = logger
+        self.warmup_data = warmup_data
+        self.on_swap = on_swap
+        self.__model = None
+        self.__lock = threading.Lock()
+
+    def get(self):
+        return self.__model
+
+    def load(self, loader):
+        # serializes concurrent loads, the active model stays available meanwhile
+        with self.__lock:
+            model_load_duration, model_warmup_duration = get_model_gauges()
+            start = time.perf_counter()
+            model = loader()
+            load_duration = time.perf_counter() - start
+            model_load_duration.set(load_duration)
+            warmup_duration = 0
+            if self.warmup_data is not None:
+                start = time.perf_counter()
+                model.predict(self.warmup_data)
+                warmup_duration = time.perf_counter() - start
+                model_warmup_duration.set(warmup_duration)
+            self.__model = model
+            self.logger.debug(f"Swapped model, loading took {load_duration:.3f}s, warm-up took {warmup_duration:.3f}s")
+            if self.on_swap:
+                self.on_swap(model)
+            return model
+
+class ModelCache():
+    # Local copies of downloaded models under <data_path>/models.
+    # Entries are addressed by a hash of job ID and registered model version, so a new production version of a job
+    # never matches an old entry. The least recently used entries are evicted once the cache exceeds max_bytes.
+
+    def __init__(self, logger, data_path, max_bytes):
+        self.logger = logger
+        self.path = os.path.join(data_path, MODEL_CACHE_DIR)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def __entry_path(self, job_id, version):
+        return os.path.join(self.path, hashlib.sha256(f"{job_id}:{version}".encode()).hexdigest())
+
+    def __get_production_version(self, job_id):
+        import mlflow
+        return mlflow.MlflowClient().get_model_version_by_alias(job_id, "production").version
+
+    def get_cached_path(self, job_id):
+        # path of the cached production model of the job or None
+        path = self.__entry_path(job_id, self.__get_production_version(job_id))
+        if os.path.isdir(path):
+            return path
+        return None
+
+    def load(self, job_id):
+        import mlflow
+        version = self.__get_production_version(job_id)
+        path = self.__entry_path(job_id, version)
+        if os.path.isdir(path):
+            self.logger.debug(f"Load model {job_id} version {version} from cache")
+            os.utime(path)
+        else:
+            self.logger.debug(f"Download model {job_id} version {version} to cache")
+            tmp_path = path + ".tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            mlflow.artifacts.download_artifacts(artifact_uri=f"models:/{job_id}/{version}", dst_path=tmp_path)
+            os.rename(tmp_path, path)
+            self.__evict(keep=path)
+        return mlflow.pyfunc.load_model(path)
+
+    def __evict(self, keep):
+        entries = list()
+        total = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if not os.path.isdir(path) or path.endswith(".tmp"):
+                continue
+            size = sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+            entries.append((os.path.getmtime(path), size, path))
+            total += size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            self.logger.debug(f"Evict cached model {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
 class Downloader(threading.Thread):
+    # Sleeps on a condition until a check is enabled, then polls the job status with exponential backoff,
+    # starting at check_interval_seconds and doubling up to max_check_interval_seconds.
+    # enable_check and stop wake the thread up immediately.
+
     def __init__(
         self, 
         logger,
@@ -17,33 +128,72 @@ class Downloader(threading.Thread):
         mlflow_url,
         ml_trainer_url,
         check_interval_seconds=60,
+        max_check_interval_seconds=None,
+        warmup_data=None,
+        cache=None
     ):
         threading.Thread.__init__(self)
         self.logger = logger 
         self.check_interval_seconds = check_interval_seconds
+        self.max_check_interval_seconds = max_check_interval_seconds or check_interval_seconds * 16
         self.detector_class_ref = detector_class_ref
+        self.model_holder = ModelHolder(logger, warmup_data, on_swap=self.__set_model)
+        self.cache = cache
         self.ml_trainer_url = ml_trainer_url
+        self.__condition = threading.Condition()
+        self.__generation = 0
         self.__stop = False
+        self.__check_cache = False
         self.check = False
         self.job_id = None
+        import mlflow
+        from model_trainer_client.trainer import TrainerClient
         self.client = TrainerClient(ml_trainer_url, logger)
         mlflow.set_tracking_uri(mlflow_url)
 
     def run(self):
         self.logger.info("Start Downloader Thread")
-        while not self.__stop:
-            while self.check:
-                self.__check()
-                self.__wait()
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.check or self.__stop)
+                if self.__stop:
+                    break
+                generation = self.__generation
+            interval = self.check_interval_seconds
+            while self.check and not self.__stop and generation == self.__generation:
+                try:
+                    self.__check()
+                except Exception as ex:
+                    self.logger.error(f"Checking job {self.job_id} failed: {ex}")
+                if not self.check:
+                    break
+                self.__wait(interval, generation)
+                interval = min(interval * 2, self.max_check_interval_seconds)
 
-    def __wait(self):
-        time.sleep(self.check_interval_seconds)
+    def __wait(self, timeout, generation):
+        # returns early on stop or if a check for another job was enabled
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__stop or self.__generation != generation, timeout)
 
     def __check(self):
         if not self.job_id:
             self.logger.debug(f"Job ID missing")
             return 
 
+        if self.__check_cache:
+            # only done once for a persisted job, a new job has no production alias until it is ready
+            self.__check_cache = False
+            try:
+                cached = self.cache.get_cached_path(self.job_id)
+            except Exception as ex:
+                self.logger.debug(f"No cached model for job {self.job_id}: {ex}")
+                cached = None
+            if cached:
+                # cached model is still the production version, no need to ask the trainer
+                self.__download()
+                self.disable_check()
+                return
+
         if not self.client.is_job_ready(self.job_id):
             self.logger.debug(f"Job {self.job_id} not ready yet")
             return
@@ -54,28 +204,43 @@ class Downloader(threading.Thread):
     def __download(self):
         model_uri = f"models:/{self.job_id}@production"
         self.logger.debug(f"Try to download model {self.job_id}")
-        model = mlflow.pyfunc.load_model(model_uri)
+        if self.cache:
+            self.model_holder.load(lambda: self.cache.load(self.job_id))
+        else:
+            import mlflow
+            self.model_holder.load(lambda: mlflow.pyfunc.load_model(model_uri))
         self.logger.debug(f"Downloading model {self.job_id} was succesfull")
+
+    def __set_model(self, model):
         self.detector_class_ref.model = model
     
     def stop(self):
         self.logger.info("Stop Downloader Loop")
-        self.disable_check()
-        self.__stop = True
+        with self.__condition:
+            self.check = False
+            self.__stop = True
+            self.__condition.notify_all()
 
-    def enable_check(self, job_id):
+    def enable_check(self, job_id, check_cache=False):
+        # check_cache: look for a cached production model before asking the trainer, used for persisted jobs
         self.logger.info(f"Check for job id: {job_id}")
-        self.job_id = job_id
-        self.check = True
+        with self.__condition:
+            self.job_id = job_id
+            self.check = True
+            self.__check_cache = check_cache and self.cache is not None
+            self.__generation += 1
+            self.__condition.notify_all()
 
     def disable_check(self):
-        self.check = False
+        with self.__condition:
+            self.check = False
 
 class Trainer():
     # Manages model trainings, polls for status and downloads the model
     # When instantiated, it will check for an existing/persisted job id 
     # Otherwise it will poll for job status after a job was created
     # The polling is done in a background thread within an interval
+    # Downloaded models are cached under data_path, set model_cache_max_bytes to None to disable the cache
     
     def __init__(
         self, 
@@ -88,7 +253,9 @@ class Trainer():
         train_level,
         retrain: bool,
         mlflow_url,
-        check_interval_seconds
+        check_interval_seconds,
+        warmup_data=None,
+        model_cache_max_bytes=1024**3
     ) -> None:
         self.logger = logger
         self.data_path = data_path
@@ -98,6 +265,7 @@ class Trainer():
         self.train_interval = train_interval
         self.train_level = train_level
         self.retrain = retrain
+        from model_trainer_client.trainer import TrainerClient
         self.client = TrainerClient(ml_trainer_url, logger)
         
         self.downloader = Downloader(
@@ -105,7 +273,9 @@ class Trainer():
             detector_class_ref,
             mlflow_url,
             ml_trainer_url,
-            check_interval_seconds
+            check_interval_seconds,
+            warmup_data=warmup_data,
+            cache=ModelCache(logger, data_path, model_cache_max_bytes) if model_cache_max_bytes else None
         )
 
         self.downloader.start() # Start the downloader thread
@@ -113,7 +283,7 @@ class Trainer():
 
     def check_exisiting_job_id(self):
         if self.job_id:
-            self.downloader.enable_check(self.job_id)
+            self.downloader.enable_check(self.job_id, check_cache=True)
 
     def start_training(self, job_request):
         self.job_id = self.client.start_training(job_request)
@@ -122,6 +292,7 @@ class Trainer():
         self.downloader.enable_check(self.job_id)
 
     def training_shall_start(self, timestamp):
+        import pandas as pd
         if not self.retrain and self.job_id:
             self.logger.debug("Retrain is disabled and there a job exists already.")
             return False
@@ -24,6 +24,7 @@ import typing
 class Selector(simple_struct.Structure):
     name: str = None
     args: typing.Set[str] = None
+    handler: str = None # Optional name of an operator method called instead of run for this selector.
 
     def __init__(self, d, **kwargs):
         super().__init__(d, **kwargs)
@@ -0,0 +1,154 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("OffsetTracker", "OffsetCommitter")
+
+from .logger import logger
+import collections
+import threading
+import time
+import typing
+import confluent_kafka
+
+
+class PartitionOffsets:
+    def __init__(self):
+        self.pending = collections.deque()
+        self.done = set()
+        self.next_offset = None
+        self.changed = False
+
+    def add(self, offset: int):
+        self.pending.append(offset)
+
+    def mark_done(self, offset: int):
+        self.done.add(offset)
+        while self.pending and self.pending[0] in self.done:
+            self.done.discard(self.pending[0])
+            self.next_offset = self.pending.popleft() + 1
+            self.changed = True
+
+
+class OffsetTracker:
+    """
+    Tracks in-flight messages per partition. An offset only becomes committable once the message
+    and all messages consumed before it from the same partition are done.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__partitions: typing.Dict[typing.Tuple[str, int], PartitionOffsets] = dict()
+
+    def add(self, topic: str, partition: int, offset: int) -> PartitionOffsets:
+        with self.__lock:
+            key = (topic, partition)
+            if key not in self.__partitions:
+                self.__partitions[key] = PartitionOffsets()
+            self.__partitions[key].add(offset)
+            return self.__partitions[key]
+
+    def done(self, p_offsets: PartitionOffsets, offset: int):
+        # offsets of a removed partition are marked on the detached instance and have no effect
+        with self.__lock:
+            p_offsets.mark_done(offset)
+
+    def remove(self, topic: str, partition: int):
+        with self.__lock:
+            self.__partitions.pop((topic, partition), None)
+
+    def get_commit_offsets(self) -> typing.List[confluent_kafka.TopicPartition]:
+        """
+        :return: Partitions whose committable offset advanced since the last call.
+        """
+        offsets = list()
+        with self.__lock:
+            for (topic, partition), p_offsets in self.__partitions.items():
+                if p_offsets.changed:
+                    offsets.append(confluent_kafka.TopicPartition(topic, partition, p_offsets.next_offset))
+                    p_offsets.changed = False
+        return offsets
+
+
+class OffsetCommitter:
+    """
+    Tracks consumed messages and passes committable offsets to the consumer.
+    With manual commits offsets are committed asynchronously every commit_records records or commit_interval seconds,
+    requires enable.auto.commit=false. Otherwise offsets are stored for auto-commit, requires
+    enable.auto.offset.store=false.
+    """
+
+    def __init__(self, kafka_consumer: confluent_kafka.Consumer, manual_commit: bool, commit_records: int, commit_interval: float):
+        self.__kafka_consumer = kafka_consumer
+        self.__tracker = OffsetTracker()
+        self.__manual_commit = manual_commit
+        self.__commit_records = commit_records
+        self.__commit_interval = commit_interval
+        self.__uncommitted = 0
+        self.__last_commit = time.monotonic()
+
+    def track(self, msg_obj) -> typing.Tuple[PartitionOffsets, int]:
+        offset = msg_obj.offset()
+        self.__uncommitted += 1
+        return self.__tracker.add(msg_obj.topic(), msg_obj.partition(), offset), offset
+
+    def done(self, offsets: typing.List[typing.Tuple[PartitionOffsets, int]]):
+        for offset in offsets:
+            self.__tracker.done(*offset)
+
+    def revoke(self, partitions: typing.List[confluent_kafka.TopicPartition]):
+        """
+        Commits or stores the done offsets and forgets the partitions, must be called from the revoke callback.
+        Messages of these partitions that are done afterwards are consumed again by the new owner.
+        """
+        self.handle(force=True)
+        self.lose(partitions)
+
+    def lose(self, partitions: typing.List[confluent_kafka.TopicPartition]):
+        # forgets the partitions without committing, their offsets may already belong to another consumer
+        for partition in partitions:
+            self.__tracker.remove(partition.topic, partition.partition)
+
+    def __store(self):
+        offsets = self.__tracker.get_commit_offsets()
+        if offsets:
+            try:
+                self.__kafka_consumer.store_offsets(offsets=offsets)
+            except confluent_kafka.KafkaException as ex:
+                # e.g. partition was revoked in the meantime
+                logger.warning(f"storing offsets failed: {ex}")
+
+    def __commit(self, force: bool):
+        now = time.monotonic()
+        if not force and self.__uncommitted < self.__commit_records and now - self.__last_commit < self.__commit_interval:
+            return
+        self.__uncommitted = 0
+        self.__last_commit = now
+        offsets = self.__tracker.get_commit_offsets()
+        if offsets:
+            try:
+                self.__kafka_consumer.commit(offsets=offsets, asynchronous=not force)
+            except confluent_kafka.KafkaException as ex:
+                logger.warning(f"committing offsets failed: {ex}")
+
+    def handle(self, force: bool = False):
+        """
+        Must be called from the consumer thread.
+        :param force: Commit synchronously regardless of the commit interval, used on shutdown.
+        """
+        if self.__manual_commit:
+            self.__commit(force)
+        else:
+            self.__store()
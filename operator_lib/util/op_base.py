@@ -14,16 +14,37 @@
    limitations under the License.
 """
 
-__all__ = ("OperatorBase",)
+__all__ = ("OperatorBase", "Record", "TIMESTAMP_DATETIME", "TIMESTAMP_UTC", "TIMESTAMP_EPOCH_MS")
 
 from .logger import logger
 from .model import Config, Selector
+from .executor import ShardedExecutor
+from .offsets import OffsetCommitter
+from .output import OutputProducer, PARTITIONING_DEVICE_ID
+from .flow import FlowControl, AdaptivePollTimeout, PAUSED_WAIT
+from .prefilter import PreFilter
+from .metrics import OperatorMetrics, StageTimer, STAGE_POLL, STAGE_QUEUE, STAGE_DECODE, STAGE_MATCH, STAGE_FLUSH
+from . import codec
 import confluent_kafka
-import mf_lib
-import json
 import typing
 import datetime
-import typing
+import time
+
+if typing.TYPE_CHECKING:
+    import mf_lib
+    from .profiler import RunTimings
+
+TIMESTAMP_DATETIME = "datetime" # naive datetime in local time
+TIMESTAMP_UTC = "utc" # timezone aware datetime in UTC
+TIMESTAMP_EPOCH_MS = "epoch_ms" # integer milliseconds since epoch
+
+EPOCH_UTC = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class Record(typing.NamedTuple):
+    data: typing.Dict[str, typing.Any]
+    device_id: str
+    timestamp: datetime.datetime
 
 
 def log_kafka_sub_action(action: str, partitions: typing.List):
@@ -45,122 +66,368 @@ def on_lost(_, p):
     log_kafka_sub_action("lost", p)
 
 
+def on_commit(err, partitions):
+    if err:
+        logger.error(f"commit failed: {err}")
+    else:
+        for partition in partitions:
+            if partition.error:
+                logger.error(f"commit failed: topic={partition.topic} partition={partition.partition} error={partition.error}")
+
+
+def get_timestamp_converter(timestamp_type: str) -> typing.Callable[[typing.Optional[int]], typing.Any]:
+    """
+    :return: Function converting a Kafka timestamp in milliseconds, or None for now, to the given timestamp type.
+    """
+    if timestamp_type == TIMESTAMP_DATETIME:
+        return lambda ms: datetime.datetime.fromtimestamp(ms/1000) if ms is not None else datetime.datetime.now()
+    if timestamp_type == TIMESTAMP_UTC:
+        return lambda ms: EPOCH_UTC + datetime.timedelta(milliseconds=ms) if ms is not None else datetime.datetime.now(datetime.timezone.utc)
+    if timestamp_type == TIMESTAMP_EPOCH_MS:
+        return lambda ms: ms if ms is not None else time.time_ns() // 1000000
+    raise ValueError(f"unknown timestamp type '{timestamp_type}'")
+
+
+def get_timestamp(msg_obj, convert: typing.Callable[[typing.Optional[int]], typing.Any]):
+    ts_data = msg_obj.timestamp()
+    if ts_data[0] != confluent_kafka.TIMESTAMP_NOT_AVAILABLE:
+        return convert(ts_data[1])
+    logger.error("Kafka Broker does not support timestamps, using now() as substitute")
+    return convert(None)
+
+
+class SelectorDispatcher:
+    """
+    Maps filter IDs to selector name and handler, dispatching a match is a single dict lookup.
+    The index is built upfront for filter handlers created by create_filter_handler, other filter handlers are asked
+    for the selector of a filter ID once.
+    """
+
+    def __init__(
+        self,
+        filter_handler: "mf_lib.FilterHandler",
+        selectors: typing.List[Selector],
+        operator,
+        default_handler: typing.Callable,
+        on_error: typing.Callable
+    ):
+        self.__filter_handler = filter_handler
+        self.__handlers = {s.name: getattr(operator, s.handler) for s in selectors if s.handler}
+        self.__default_handler = default_handler
+        self.__on_error = on_error
+        self.__index: typing.Dict[str, typing.Tuple[str, typing.Callable]] = dict()
+        # mf_lib is already loaded by whoever created the filter handler
+        import mf_lib.exceptions
+        self.__errors = mf_lib.exceptions
+        from . import get_filter_selectors
+        for f_id, selector in (get_filter_selectors(filter_handler) or dict()).items():
+            self.__index[f_id] = (selector, self.get_handler(selector))
+
+    def __resolve(self, f_id: str) -> typing.Tuple[str, typing.Callable]:
+        selector = self.__filter_handler.get_filter_args(id=f_id)["selector"]
+        entry = (selector, self.get_handler(selector))
+        self.__index[f_id] = entry
+        return entry
+
+    def get_handler(self, selector: str) -> typing.Callable:
+        return self.__handlers.get(selector, self.__default_handler)
+
+    def iter_matches(self, message, device_id):
+        """
+        Yields selector, handler and extracted data for every filter matching the message.
+        """
+        index = self.__index
+        try:
+            for result in self.__filter_handler.get_results(message=message):
+                if not result.ex:
+                    for f_id in result.filter_ids:
+                        entry = index.get(f_id) or self.__resolve(f_id)
+                        yield entry[0], entry[1], result.data
+                else:
+                    logger.error(result.ex)
+                    self.__on_error(result.ex, message, device_id)
+        except self.__errors.NoFilterError:
+            pass
+        except self.__errors.MessageIdentificationError as ex:
+            logger.error(ex)
+
+
 class OperatorBase:
     configType = Config # Subclasses may override this with a subclass of Config.
     config = configType({})
     selectors: typing.List[Selector] = [] # Subclasses should fill these.
+    timestampType = TIMESTAMP_DATETIME # Subclasses may override this to receive timestamps as TIMESTAMP_UTC or TIMESTAMP_EPOCH_MS.
 
     def __new__(cls, *args, **kwargs):
         obj = super(OperatorBase, cls).__new__(cls)
+        setattr(obj, f"_{OperatorBase.__name__}__convert_timestamp", None)
         setattr(obj, f"_{OperatorBase.__name__}__kafka_consumer", None)
-        setattr(obj, f"_{OperatorBase.__name__}__kafka_producer", None)
         setattr(obj, f"_{OperatorBase.__name__}__filter_handler", None)
-        setattr(obj, f"_{OperatorBase.__name__}__output_topic", None)
+        setattr(obj, f"_{OperatorBase.__name__}__dispatcher", None)
+        setattr(obj, f"_{OperatorBase.__name__}__output", None)
         setattr(obj, f"_{OperatorBase.__name__}__pipeline_id", None)
         setattr(obj, f"_{OperatorBase.__name__}__operator_id", None)
         setattr(obj, f"_{OperatorBase.__name__}__poll_timeout", None)
+        setattr(obj, f"_{OperatorBase.__name__}__flow", None)
+        setattr(obj, f"_{OperatorBase.__name__}__prefilter", None)
+        setattr(obj, f"_{OperatorBase.__name__}__watermarks", None)
+        setattr(obj, f"_{OperatorBase.__name__}__batch_size", 1)
+        setattr(obj, f"_{OperatorBase.__name__}__batch_linger", None)
+        setattr(obj, f"_{OperatorBase.__name__}__batch_by_device", False)
+        setattr(obj, f"_{OperatorBase.__name__}__executor_workers", 0)
+        setattr(obj, f"_{OperatorBase.__name__}__executor_queue_size", 0)
+        setattr(obj, f"_{OperatorBase.__name__}__executor", None)
+        setattr(obj, f"_{OperatorBase.__name__}__offsets", None)
+        setattr(obj, f"_{OperatorBase.__name__}__manual_commit", False)
+        setattr(obj, f"_{OperatorBase.__name__}__metrics", None)
+        setattr(obj, f"_{OperatorBase.__name__}__run_timings", None)
+        setattr(obj, f"_{OperatorBase.__name__}__handle_result_error", None)
+        setattr(obj, f"_{OperatorBase.__name__}__handle_delivery_error", None)
         setattr(obj, f"_{OperatorBase.__name__}__stop", False)
         setattr(obj, f"_{OperatorBase.__name__}__stopped", False)
         return obj
 
-    def __call_run(self, message, device_id, timestamp: datetime.datetime):
+    def __result_error(self, ex, message, device_id):
+        if self.__handle_result_error:
+            self.__handle_result_error(ex, message, self.produce, device_id)
+
+    def __undelivered(self, offsets):
+        logger.error(f"results of {len(offsets)} messages were not delivered, stopping so that these are consumed again after a restart")
+        self.__stop = True
+
+    def __delivery_error(self, ex, value):
+        if self.__handle_delivery_error:
+            self.__handle_delivery_error(ex, value, self.produce)
+
+    def __call_run(self, message, device_id, timestamp: datetime.datetime, timer: typing.Optional[StageTimer] = None):
         run_results = list()
-        try:
-            for result in self.__filter_handler.get_results(message=message):
-                if not result.ex:
-                    for f_id in result.filter_ids:
-                        run_result = self.run(
-                            selector=self.__filter_handler.get_filter_args(id=f_id)["selector"],
-                            data=result.data,
-                            device_id=device_id,
-                            timestamp=timestamp,
-                        )
-                        if run_result is not None:
-                            if isinstance(run_result, list):
-                                run_results += run_result
-                            else:
-                                run_results.append(run_result)
+        timings = self.__run_timings
+        for selector, handler, data in self.__dispatcher.iter_matches(message, device_id):
+            if timer:
+                timer.lap(STAGE_MATCH)
+            start = time.perf_counter() if timings is not None and timings.active else None
+            run_result = handler(
+                selector=selector,
+                data=data,
+                device_id=device_id,
+                timestamp=timestamp,
+            )
+            if start is not None:
+                timings.add(selector, time.perf_counter() - start)
+            if timer:
+                timer.lap_run(selector)
+            if run_result is not None:
+                if isinstance(run_result, list):
+                    run_results += run_result
                 else:
-                    logger.error(result.ex)
-                    self.__handle_result_error(result.ex, message, self.produce, device_id)
-
-        except mf_lib.exceptions.NoFilterError:
-            pass
-        except mf_lib.exceptions.MessageIdentificationError as ex:
-            logger.error(ex)
+                    run_results.append(run_result)
         return run_results
 
-    def __route(self):
-        msg_obj = self.__kafka_consumer.poll(timeout=self.__poll_timeout)
+    def __process(self, message, device_id, timestamp: datetime.datetime, offset, timer: typing.Optional[StageTimer] = None):
+        if timer and self.__executor:
+            timer.lap(STAGE_QUEUE)
+        self.__output.produce_results(self.__call_run(message, device_id, timestamp, timer), [offset] if offset else None, device_id, timer)
+
+    def __on_executor_error(self, ex):
+        logger.exception(ex)
+        self.__stop = True
+
+    def __reject(self, msg_obj):
+        # the message can not match any filter, its offset is done right away
+        if self.__offsets:
+            self.__offsets.done([self.__offsets.track(msg_obj)])
+        if self.__metrics:
+            self.__metrics.prefiltered += 1
+
+    def __route(self) -> typing.Optional[StageTimer]:
+        # returns the timer of a sampled iteration, unless it was handed to an executor worker
+        timer = self.__metrics.sample() if self.__metrics else None
+        msg_obj = self.__kafka_consumer.poll(timeout=self.__poll_timeout.value)
+        self.__poll_timeout.update(msg_obj is not None)
+        if timer:
+            timer.lap(STAGE_POLL)
         if msg_obj:
             if not msg_obj.error():
-                ts_data = msg_obj.timestamp()
-                if ts_data[0] != confluent_kafka.TIMESTAMP_NOT_AVAILABLE:
-                    timestamp = datetime.datetime.fromtimestamp(ts_data[1]/1000)
-                else:
-                    logger.error("Kafka Broker does not support timestamps, using now() as substitute")
-                    timestamp = datetime.datetime.now()
-                results = self.__call_run(json.loads(msg_obj.value()), json.loads(msg_obj.value()).get('device_id'), timestamp)
-                for result in results:
-                    self.__kafka_producer.produce(
-                        self.__output_topic,
-                        json.dumps(
-                            {
-                                "pipeline_id": self.__pipeline_id,
-                                "operator_id": self.__operator_id,
-                                "analytics": result,
-                                "time": "{}Z".format(datetime.datetime.utcnow().isoformat())
-                            }
-                        ),
-                        self.__operator_id
-                    )
+                if self.__prefilter and not self.__prefilter.accept(msg_obj.value()):
+                    self.__reject(msg_obj)
+                    return timer
+                timestamp = get_timestamp(msg_obj, self.__convert_timestamp)
+                message = codec.loads(msg_obj.value())
+                if timer:
+                    timer.lap(STAGE_DECODE)
+                if self.__metrics:
+                    self.__metrics.consumed += 1
+                device_id = message.get('device_id')
+                offset = self.__offsets.track(msg_obj) if self.__offsets else None
+                if self.__executor:
+                    self.__executor.submit(device_id, self.__process, message, device_id, timestamp, offset, timer)
+                    return None
+                self.__process(message, device_id, timestamp, offset, timer)
             else:
                 raise confluent_kafka.KafkaException(msg_obj.error())
+        return timer
+
+    def __route_batch(self) -> typing.Optional[StageTimer]:
+        timer = self.__metrics.sample() if self.__metrics else None
+        linger = 0 if self.__flow.paused else self.__batch_linger
+        msg_objs = self.__kafka_consumer.consume(num_messages=self.__batch_size, timeout=linger)
+        if timer:
+            timer.lap(STAGE_POLL)
+        batches: typing.Dict[typing.Tuple[str, typing.Optional[str]], typing.List[Record]] = dict()
+        offsets = list() if self.__offsets else None
+        error = None
+        consumed = 0
+        for msg_obj in msg_objs:
+            if msg_obj.error():
+                # records before the erroneous message are still handed to the operator
+                error = msg_obj.error()
+                break
+            if self.__offsets:
+                offsets.append(self.__offsets.track(msg_obj))
+            if self.__prefilter and not self.__prefilter.accept(msg_obj.value()):
+                if self.__metrics:
+                    self.__metrics.prefiltered += 1
+                continue
+            consumed += 1
+            message = codec.loads(msg_obj.value())
+            if timer:
+                timer.lap(STAGE_DECODE)
+            device_id = message.get('device_id')
+            timestamp = get_timestamp(msg_obj, self.__convert_timestamp)
+            batch_key_device_id = device_id if self.__batch_by_device else None
+            for selector, _, data in self.__dispatcher.iter_matches(message, device_id):
+                batches.setdefault((selector, batch_key_device_id), list()).append(Record(data, device_id, timestamp))
+            if timer:
+                timer.lap(STAGE_MATCH)
+        if self.__metrics:
+            self.__metrics.consumed += consumed
+        results = list()
+        device_ids = list()
+        timings = self.__run_timings
+        for (selector, device_id), records in batches.items():
+            start = time.perf_counter() if timings is not None and timings.active else None
+            batch_results = self.run_batch(selector=selector, records=records)
+            if start is not None:
+                timings.add(selector, time.perf_counter() - start)
+            if timer:
+                timer.lap_run(selector)
+            if batch_results:
+                results += batch_results
+                device_ids += [device_id] * len(batch_results)
+        self.__output.produce_results(results, offsets, timer=timer, device_ids=device_ids)
+        if error:
+            raise confluent_kafka.KafkaException(error)
+        return timer
 
     def __loop(self):
-        q = 0
-        i = 0
+        route = self.__route_batch if self.__batch_size > 1 else self.__route
         while not self.__stop:
             try:
-                self.__route()
+                paused = self.__flow.update()
+                if paused:
+                    # keep serving consumer callbacks without waiting, wait for deliveries instead
+                    self.__poll_timeout.update(True)
+                timer = route()
+                self.__output.poll(timer, PAUSED_WAIT if paused else 0)
+                if self.__offsets:
+                    self.__offsets.handle()
             except Exception as ex:
                 logger.exception(ex)
                 self.__stop = True
-            if len(self.__kafka_producer) > 0:
-                if q == len(self.__kafka_producer):
-                    i = i+1
-                else: 
-                    i = 0
-                    q = len(self.__kafka_producer)
-                if q > 10 or i == 3: # 10 msgs queued or waited for 3 cycles without new msgs
-                    self.__kafka_producer.flush()
-                    i = 0
-                    q = 0
-            else:
-                q = 0
-                i = 0
+        try:
+            if self.__executor:
+                self.__executor.shutdown()
+            start = time.perf_counter()
+            self.__output.flush()
+            if self.__metrics:
+                self.__metrics.observe(STAGE_FLUSH, time.perf_counter() - start)
+                self.__metrics.publish()
+            if self.__offsets:
+                self.__offsets.handle(force=True)
+        except Exception as ex:
+            logger.exception(ex)
         self.__stopped = True
 
     def init(
         self, 
         kafka_consumer: confluent_kafka.Consumer, 
         kafka_producer: confluent_kafka.Producer, 
-        filter_handler: mf_lib.FilterHandler, 
+        filter_handler: "mf_lib.FilterHandler", 
         output_topic: str, 
         pipeline_id: str, 
         operator_id: str, 
         poll_timeout: float = 1.0, 
         config: Config = Config({}),
-        result_error_handler = None
+        result_error_handler = None,
+        batch_size: int = 1,
+        batch_linger: float = 1.0,
+        executor_workers: int = 0,
+        executor_queue_size: int = 1000,
+        manual_commit: bool = False,
+        commit_records: int = 1000,
+        commit_interval: float = 5.0,
+        producer_queue_size: int = 100000,
+        high_watermark: float = 0.8,
+        low_watermark: float = 0.5,
+        output_partitioning: str = "operator_id",
+        output_coalesce: int = 1,
+        output_coalesce_linger: float = 0.1,
+        metrics: typing.Optional[OperatorMetrics] = None,
+        run_timings: typing.Optional["RunTimings"] = None,
+        prefilter: typing.Optional[PreFilter] = None,
+        delivery_error_handler = None
     ):
         self.__kafka_consumer = kafka_consumer
-        self.__kafka_producer = kafka_producer
         self.__filter_handler = filter_handler
-        self.__output_topic = output_topic
+        self.__dispatcher = SelectorDispatcher(
+            filter_handler=filter_handler,
+            selectors=self.selectors,
+            operator=self,
+            default_handler=self.run,
+            on_error=self.__result_error
+        )
         self.__pipeline_id = pipeline_id
         self.__operator_id = operator_id
-        self.__poll_timeout = poll_timeout
+        self.__poll_timeout = AdaptivePollTimeout(maximum=poll_timeout)
+        self.__watermarks = (high_watermark, low_watermark)
+        self.__convert_timestamp = get_timestamp_converter(self.timestampType)
+        self.__batch_size = batch_size
+        self.__batch_linger = batch_linger
+        # results of run_batch can only be keyed by device if every call gets records of a single device
+        self.__batch_by_device = output_partitioning == PARTITIONING_DEVICE_ID
+        self.__executor_workers = executor_workers
+        self.__executor_queue_size = executor_queue_size
+        if executor_workers > 1 and batch_size > 1:
+            logger.warning("executor workers are not used in batch mode, records are processed on the consumer thread")
+        self.__manual_commit = manual_commit
+        if executor_workers > 1 or manual_commit:
+            self.__offsets = OffsetCommitter(
+                kafka_consumer=kafka_consumer,
+                manual_commit=manual_commit,
+                commit_records=commit_records,
+                commit_interval=commit_interval
+            )
+        self.__output = OutputProducer(
+            kafka_producer=kafka_producer,
+            output_topic=output_topic,
+            pipeline_id=pipeline_id,
+            operator_id=operator_id,
+            on_delivery_error=self.__delivery_error,
+            on_done=self.__offsets.done if self.__offsets else None,
+            on_undelivered=self.__undelivered,
+            wait_for_delivery=manual_commit,
+            partitioning=output_partitioning,
+            coalesce=output_coalesce,
+            coalesce_linger=output_coalesce_linger,
+            metrics=metrics
+        )
+        self.__metrics = metrics
+        self.__flow = FlowControl(kafka_consumer)
+        self.__flow.watch("producer queue", self.__output.queue_depth, int(producer_queue_size * high_watermark), int(producer_queue_size * low_watermark))
+        self.__run_timings = run_timings
+        self.__prefilter = prefilter if prefilter and prefilter.enabled else None
         self.__handle_result_error = result_error_handler
+        self.__handle_delivery_error = delivery_error_handler
         self.config = config
 
     def get_pipeline_id(self) -> str:
@@ -169,17 +436,38 @@ class OperatorBase:
     def get_operator_id(self) -> str:
         return self.__operator_id
 
+    def __on_revoke(self, consumer, partitions):
+        on_revoke(consumer, partitions)
+        if self.__offsets:
+            # results of done messages are delivered first, so their offsets can be committed before the partitions move
+            if self.__manual_commit:
+                self.__output.flush()
+            self.__offsets.revoke(partitions)
+
+    def __on_lost(self, consumer, partitions):
+        on_lost(consumer, partitions)
+        if self.__offsets:
+            self.__offsets.lose(partitions)
+
     def start(self):
         sources = self.__filter_handler.get_sources()
         if sources:
             self.__kafka_consumer.subscribe(
                 sources,
                 on_assign=on_assign,
-                on_revoke=on_revoke,
-                on_lost=on_lost
+                on_revoke=self.__on_revoke,
+                on_lost=self.__on_lost
             )
         else:
             raise RuntimeError("no sources")
+        if self.__executor_workers > 1 and self.__batch_size <= 1:
+            self.__executor = ShardedExecutor(
+                workers=self.__executor_workers,
+                queue_size=self.__executor_queue_size,
+                on_error=self.__on_executor_error
+            )
+            capacity = self.__executor_workers * self.__executor_queue_size
+            self.__flow.watch("executor queue", self.__executor.pending, int(capacity * self.__watermarks[0]), int(capacity * self.__watermarks[1]))
         self.__loop()
 
     def stop(self):
@@ -188,25 +476,46 @@ class OperatorBase:
     def is_alive(self) -> bool:
         return not self.__stopped
 
-    def produce(self, value):
-        self.__kafka_producer.produce(
-            self.__output_topic,
-            json.dumps({
-                "pipeline_id": self.__pipeline_id,
-                "operator_id": self.__operator_id,
-                "analytics": value,
-                "time": "{}Z".format(datetime.datetime.utcnow().isoformat())
-            }),
-            self.__operator_id
-        )
+    def produce(self, value, device_id: typing.Optional[str] = None):
+        """
+        Produces a result outside of run, e.g. from a result or delivery error handler.
+        :param device_id: ID of the device the result belongs to, used as key if output is partitioned by device ID.
+        """
+        self.__output.produce(value, device_id=device_id)
 
     def run(self, data: typing.Dict[str, typing.Any], selector: str, device_id: str, timestamp: datetime.datetime):
         """
-        Subclasses must override this method.
+        Subclasses must override this method, unless all selectors name a handler method with the same signature.
         :param data: Dictionary containing data extracted from a message.
         :param selector: Name of a selector identifying the extracted data.
         :param device_id: ID of the device the message originates from
-        :param timestamp: Kafka stored message timestamp.
+        :param timestamp: Kafka stored message timestamp, type depends on timestampType.
         :return: Result data or None.
+        If executor workers are configured, this method is called concurrently for messages of different devices.
         """
         pass
+
+    def run_batch(self, selector: str, records: typing.List[Record]):
+        """
+        Subclasses may override this method to process several records at once. Only used if batch consumption
+        is enabled. Records are grouped by selector and keep their consumption order within a group.
+        If output is partitioned by device ID, records are grouped by selector and device ID.
+        :param selector: Name of a selector identifying the extracted data.
+        :param records: List of records, each holding data, device ID and Kafka stored message timestamp.
+        :return: List of result data or None.
+        """
+        handler = self.__dispatcher.get_handler(selector)
+        run_results = list()
+        for record in records:
+            run_result = handler(
+                selector=selector,
+                data=record.data,
+                device_id=record.device_id,
+                timestamp=record.timestamp
+            )
+            if run_result is not None:
+                if isinstance(run_result, list):
+                    run_results += run_result
+                else:
+                    run_results.append(run_result)
+        return run_results
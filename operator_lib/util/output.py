@@ -0,0 +1,250 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("OutputProducer", "PARTITIONING_OPERATOR_ID", "PARTITIONING_DEVICE_ID", "PARTITIONING_ROUND_ROBIN")
+
+from .logger import logger
+from .envelope import Envelope
+from .metrics import OperatorMetrics, StageTimer, STAGE_SERIALIZE, STAGE_PRODUCE, STAGE_FLUSH
+import confluent_kafka
+import itertools
+import threading
+import time
+import typing
+
+PARTITIONING_OPERATOR_ID = "operator_id" # all results share the operator ID as key and land on one partition
+PARTITIONING_DEVICE_ID = "device_id" # results are keyed by the device ID of their input message
+PARTITIONING_ROUND_ROBIN = "round_robin" # results are spread over all partitions of the output topic
+
+
+class PendingOffsets:
+    # offsets of one produce_results call and the number of its results that are not handled yet
+    __slots__ = ("offsets", "remaining", "failed")
+
+    def __init__(self, offsets, remaining: int):
+        self.offsets = offsets
+        self.remaining = remaining
+        self.failed = False
+
+
+class CoalesceBuffer:
+    # results waiting to be packed into one record
+    __slots__ = ("since", "results", "pending")
+
+    def __init__(self, since: float):
+        self.since = since
+        self.results = list()
+        self.pending: typing.Dict[PendingOffsets, int] = dict()
+
+
+class OutputProducer:
+    """
+    Wraps results into the output envelope and hands them to the producer without blocking.
+    Delivery reports are served by poll, failed deliveries are passed to on_delivery_error.
+    """
+
+    def __init__(
+        self,
+        kafka_producer: confluent_kafka.Producer,
+        output_topic: str,
+        pipeline_id: str,
+        operator_id: str,
+        on_delivery_error: typing.Optional[typing.Callable] = None,
+        on_done: typing.Optional[typing.Callable] = None,
+        on_undelivered: typing.Optional[typing.Callable] = None,
+        wait_for_delivery: bool = False,
+        partitioning: str = PARTITIONING_OPERATOR_ID,
+        coalesce: int = 1,
+        coalesce_linger: float = 0.1,
+        metrics: typing.Optional[OperatorMetrics] = None
+    ):
+        """
+        :param on_delivery_error: Called with exception and the encoded output record if a delivery failed.
+        :param on_done: Called with the offsets passed to produce_results once these are handled.
+        :param on_undelivered: Called with the offsets passed to produce_results if one of their results failed delivery, these offsets are never passed to on_done.
+        :param wait_for_delivery: Only call on_done after all results were delivered instead of after enqueueing them.
+        :param partitioning: Key or partition selection for output records, results without device ID fall back to the operator ID.
+        :param coalesce: If greater than 1, results are packed into records holding JSON arrays of up to this many results.
+        Results of consecutive produce_results calls are buffered per key until a record is full.
+        :param coalesce_linger: Seconds after which a record that is not full is produced by the next poll call.
+        """
+        if partitioning not in (PARTITIONING_OPERATOR_ID, PARTITIONING_DEVICE_ID, PARTITIONING_ROUND_ROBIN):
+            raise ValueError(f"unknown output partitioning '{partitioning}'")
+        self.__kafka_producer = kafka_producer
+        self.__output_topic = output_topic
+        self.__operator_id = operator_id
+        self.__envelope = Envelope(pipeline_id=pipeline_id, operator_id=operator_id)
+        self.__on_delivery_error = on_delivery_error
+        self.__on_done = on_done
+        self.__on_undelivered = on_undelivered
+        self.__wait_for_delivery = wait_for_delivery
+        self.__partitioning = partitioning
+        self.__coalesce = max(coalesce, 1)
+        self.__coalesce_linger = coalesce_linger
+        self.__buffers: typing.Dict[typing.Optional[str], CoalesceBuffer] = dict()
+        # guards buffers and pending offsets, executor workers produce concurrently
+        self.__lock = threading.RLock()
+        self.__partition_counter = itertools.count()
+        self.__partition_count = None
+        self.__metrics = metrics
+
+    def __on_delivery(self, err, msg):
+        if err:
+            if self.__metrics:
+                self.__metrics.delivery_errors += 1
+            logger.error(f"delivery failed: {err}")
+            if self.__on_delivery_error:
+                self.__on_delivery_error(confluent_kafka.KafkaException(err), msg.value())
+        elif self.__metrics:
+            self.__metrics.delivered += 1
+
+    def __settle(self, pending: PendingOffsets, count: int, err=None):
+        # count results of the call were enqueued or delivered
+        with self.__lock:
+            if pending.failed:
+                return
+            if err:
+                # offsets stay pending, so they are never committed
+                pending.failed = True
+            else:
+                pending.remaining -= count
+                if pending.remaining:
+                    return
+        if not err:
+            self.__on_done(pending.offsets)
+        elif self.__on_undelivered:
+            self.__on_undelivered(pending.offsets)
+
+    def __gen_delivery_callback(self, pending: typing.List[typing.Tuple[PendingOffsets, int]]):
+        def on_delivery(err, msg):
+            self.__on_delivery(err, msg)
+            for call_pending, count in pending:
+                self.__settle(call_pending, count, err)
+
+        return on_delivery
+
+    def __get_partition_count(self):
+        if self.__partition_count is None:
+            metadata = self.__kafka_producer.list_topics(self.__output_topic, timeout=10)
+            self.__partition_count = len(metadata.topics[self.__output_topic].partitions) or 1
+        return self.__partition_count
+
+    def produce(self, value, on_delivery=None, device_id: typing.Optional[str] = None, timer: typing.Optional[StageTimer] = None):
+        value = self.__envelope.encode(value)
+        if timer:
+            timer.lap(STAGE_SERIALIZE)
+        kwargs = dict()
+        if self.__partitioning == PARTITIONING_ROUND_ROBIN:
+            kwargs["partition"] = next(self.__partition_counter) % self.__get_partition_count()
+        elif self.__partitioning == PARTITIONING_DEVICE_ID and device_id:
+            kwargs["key"] = device_id
+        else:
+            kwargs["key"] = self.__operator_id
+        while True:
+            try:
+                self.__kafka_producer.produce(
+                    self.__output_topic,
+                    value,
+                    on_delivery=on_delivery or self.__on_delivery,
+                    **kwargs
+                )
+                break
+            except BufferError:
+                # local queue is full, serve delivery reports until there is room again
+                logger.debug("producer queue full, waiting for deliveries")
+                self.__kafka_producer.poll(0.1)
+        if timer:
+            timer.lap(STAGE_PRODUCE)
+
+    def __produce_record(self, value, pending: typing.List[typing.Tuple[PendingOffsets, int]], device_id, timer):
+        if pending and self.__wait_for_delivery:
+            self.produce(value, self.__gen_delivery_callback(pending), device_id, timer)
+        else:
+            self.produce(value, None, device_id, timer)
+            for call_pending, count in pending:
+                self.__settle(call_pending, count)
+
+    def __flush_buffer(self, key: typing.Optional[str], timer: typing.Optional[StageTimer] = None):
+        buffer = self.__buffers.pop(key)
+        self.__produce_record(buffer.results, list(buffer.pending.items()), key, timer)
+
+    def __flush_buffers(self, linger: float = 0):
+        with self.__lock:
+            now = time.monotonic()
+            for key in [key for key, buffer in self.__buffers.items() if now - buffer.since >= linger]:
+                self.__flush_buffer(key)
+
+    def produce_results(
+        self,
+        results: typing.List,
+        offsets=None,
+        device_id: typing.Optional[str] = None,
+        timer: typing.Optional[StageTimer] = None,
+        device_ids: typing.Optional[typing.List[typing.Optional[str]]] = None
+    ):
+        """
+        :param results: Result data of one or more messages.
+        :param offsets: Topic, partition and offset of the messages the results originate from.
+        :param device_id: ID of the device the results originate from, if they belong to a single device.
+        :param timer: Timer of a sampled message, serialization and produce calls are observed.
+        :param device_ids: ID of the device of every result, used instead of device_id if results of several devices are mixed.
+        """
+        if device_ids is None:
+            records = [(result, device_id) for result in results]
+        else:
+            records = list(zip(results, device_ids))
+        if not records:
+            if offsets:
+                self.__on_done(offsets)
+            return
+        pending = PendingOffsets(offsets, len(records)) if offsets else None
+        if self.__coalesce == 1:
+            on_delivery = self.__gen_delivery_callback([(pending, 1)]) if pending and self.__wait_for_delivery else None
+            for result, result_device_id in records:
+                self.produce(result, on_delivery, result_device_id, timer)
+            if offsets and not self.__wait_for_delivery:
+                self.__on_done(offsets)
+            return
+        by_device = self.__partitioning == PARTITIONING_DEVICE_ID
+        with self.__lock:
+            now = time.monotonic()
+            for result, result_device_id in records:
+                # a record only holds results of one device, so it keeps the device ID as key
+                key = result_device_id if by_device else None
+                buffer = self.__buffers.get(key)
+                if buffer is None:
+                    buffer = self.__buffers[key] = CoalesceBuffer(now)
+                buffer.results.append(result)
+                if pending:
+                    buffer.pending[pending] = buffer.pending.get(pending, 0) + 1
+                if len(buffer.results) >= self.__coalesce:
+                    self.__flush_buffer(key, timer)
+
+    def poll(self, timer: typing.Optional[StageTimer] = None, timeout: float = 0):
+        # produce lingering coalesced records and serve delivery reports, by default without blocking
+        if self.__buffers:
+            self.__flush_buffers(self.__coalesce_linger)
+        self.__kafka_producer.poll(timeout)
+        if timer:
+            timer.lap(STAGE_FLUSH)
+
+    def queue_depth(self) -> int:
+        # number of records waiting for delivery
+        return len(self.__kafka_producer)
+
+    def flush(self):
+        self.__flush_buffers()
+        self.__kafka_producer.flush()
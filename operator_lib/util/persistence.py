@@ -1,17 +1,26 @@
 import os 
 import pickle 
 
+from operator_lib.util.state_store import get_state_store
+
+MISSING = object()
+
 def load(data_path, file_name, default=None):
+    store = get_state_store(data_path)
+    value = store.get(file_name, MISSING)
+    if value is not MISSING:
+        return value
+    # state saved by previous versions as one pickle file per value, moved to the store on first load
     file_path = os.path.join(data_path, file_name)
     if not os.path.exists(file_path):
         return default 
     with open(file_path, 'rb') as f:
-        timestamp = pickle.load(f)
-        return timestamp
+        value = pickle.load(f)
+    store.put(file_name, value)
+    store.commit()
+    return value
 
 def save(data_path, file_name, value):
-    if not os.path.exists(data_path):
-        os.makedirs(data_path)
-    file_path = os.path.join(data_path, file_name)
-    with open(file_path, 'wb') as f:
-        pickle.dump(value, f)
\ No newline at end of file
+    store = get_state_store(data_path)
+    store.put(file_name, value)
+    store.commit()
@@ -0,0 +1,97 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("PreFilter",)
+
+from .logger import logger
+import re
+import string
+import typing
+
+# values made of these characters are encoded verbatim by every JSON encoder, others may be escaped (e.g. "\/")
+SAFE_CHARS = frozenset(string.ascii_letters + string.digits + ":-_.@+#=~ ")
+
+# up to this number of filters the identifier values are searched directly, above that one pass extracts all
+# identifier key/value pairs of a message and filters are looked up by their first pair
+SCAN_LIMIT = 32
+
+
+def is_safe(value) -> bool:
+    return isinstance(value, str) and bool(value) and all(char in SAFE_CHARS for char in value)
+
+
+class PreFilter:
+    """
+    Rejects raw message values that can not match any filter, without decoding them.
+    A message can only match a filter if every identifier value of the filter occurs in it as a JSON string, so a
+    message passes as soon as this holds for one filter. Identifier values with characters that an encoder may
+    escape are not checked, if a filter has no checkable value at all every message passes.
+    """
+
+    def __init__(self, identifier_sets: typing.Iterable[typing.Iterable[typing.Tuple[str, str]]]):
+        """
+        :param identifier_sets: Identifier key and value pairs per filter, as generated by gen_identifiers.
+        """
+        self.__enabled = True
+        filters = set()
+        for identifiers in identifier_sets:
+            pairs = tuple(sorted((key, value) for key, value in identifiers if is_safe(key) and is_safe(value)))
+            if not pairs:
+                self.__enabled = False
+            filters.add(pairs)
+        self.__needles = [tuple(f'"{value}"'.encode() for _, value in pairs) for pairs in filters]
+        self.__pattern = None
+        self.__index: typing.Dict[typing.Tuple[bytes, bytes], typing.List[typing.FrozenSet]] = dict()
+        if self.__enabled and len(filters) > SCAN_LIMIT:
+            keys = sorted({key for pairs in filters for key, _ in pairs})
+            self.__pattern = re.compile(rb'"(' + b"|".join(re.escape(key.encode()) for key in keys) + rb')"\s*:\s*"([^"\\]*)"')
+            for pairs in filters:
+                encoded = [(key.encode(), value.encode()) for key, value in pairs]
+                self.__index.setdefault(encoded[0], list()).append(frozenset(encoded[1:]))
+        logger.debug(f"prefilter {'enabled' if self.__enabled else 'disabled'} for {len(filters)} filters")
+
+    @classmethod
+    def from_input_topics(cls, input_topics, pipeline_id: str) -> "PreFilter":
+        from . import gen_identifiers
+        identifier_sets = list()
+        for input_topic in input_topics:
+            # filterValue can be a list, see create_filter_handler
+            for filter_value in input_topic.filterValue.split(','):
+                identifiers = gen_identifiers(name=input_topic.name, f_type=input_topic.filterType, f_value=filter_value, pipeline_id=pipeline_id)
+                identifier_sets.append([(i["key"], i["value"]) for i in identifiers or ()])
+        return cls(identifier_sets)
+
+    @property
+    def enabled(self) -> bool:
+        return self.__enabled
+
+    def accept(self, value: bytes) -> bool:
+        if not self.__enabled:
+            return True
+        if self.__pattern is None:
+            for needles in self.__needles:
+                for needle in needles:
+                    if needle not in value:
+                        break
+                else:
+                    return True
+        else:
+            found = set(self.__pattern.findall(value))
+            for pair in found:
+                for rest in self.__index.get(pair, ()):
+                    if rest <= found:
+                        return True
+        return False
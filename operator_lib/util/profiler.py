@@ -0,0 +1,214 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("StackSampler", "RunTimings", "ProfilerServer")
+
+from .logger import logger
+import collections
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import typing
+import urllib.parse
+
+MAX_SECONDS = 300
+MIN_INTERVAL = 0.001 # shorter sampling intervals would starve the consume loop of the GIL
+
+
+class StackSampler:
+    """
+    Statistical profiler, samples the stacks of all threads via sys._current_frames in the calling thread.
+    The running threads are not interrupted, so sampling a live operator is safe.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+
+    @staticmethod
+    def __frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def sample(self, seconds: float) -> typing.Dict[str, int]:
+        """
+        :return: Collapsed stacks, root first and separated by ';', mapped to the number of samples.
+        """
+        own_ident = threading.get_ident()
+        counts = collections.Counter()
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = list()
+                while frame is not None:
+                    stack.append(self.__frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return counts
+
+    @staticmethod
+    def collapse(counts: typing.Dict[str, int]) -> str:
+        # format read by flamegraph.pl, speedscope and similar tools
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items()))
+
+
+class RunTimings:
+    """
+    Per-selector timing table of run calls. Timing only happens while active, operator bases check the flag per call.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.__lock = threading.Lock()
+        self.__table: typing.Dict[str, typing.List] = dict()
+
+    def start(self):
+        with self.__lock:
+            self.__table = dict()
+        self.active = True
+
+    def stop(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        self.active = False
+        with self.__lock:
+            table = self.__table
+        return {
+            selector: {
+                "count": count,
+                "total_s": total,
+                "mean_ms": total / count * 1000,
+                "max_ms": maximum * 1000
+            } for selector, (count, total, maximum) in sorted(table.items(), key=lambda item: item[1][1], reverse=True)
+        }
+
+    def add(self, selector: str, duration: float):
+        with self.__lock:
+            entry = self.__table.get(selector)
+            if entry is None:
+                self.__table[selector] = [1, duration, duration]
+            else:
+                entry[0] += 1
+                entry[1] += duration
+                if duration > entry[2]:
+                    entry[2] = duration
+
+
+def top_allocations(seconds: float, limit: int, frames: int = 1) -> typing.List[str]:
+    # starts tracemalloc for the duration unless it is already tracing, allocations of tracemalloc itself are excluded
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(frames)
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    return [str(stat) for stat in snapshot.statistics("lineno")[:limit]]
+
+
+class ProfilerServer:
+    """
+    Opt-in HTTP profiling endpoints, served in a daemon thread. Only one profiling session runs at a time.
+    GET /stacks?seconds=10&interval=0.005  collapsed stacks of all threads
+    GET /selectors?seconds=10              run timing table per selector
+    GET /allocations?seconds=10&limit=25   top allocating source lines
+    """
+
+    def __init__(self, port: int, run_timings: typing.Optional[RunTimings] = None, address: str = ""):
+        self.run_timings = run_timings
+        self.__session = threading.Lock()
+        self.__server = http.server.ThreadingHTTPServer((address, port), self.__gen_handler())
+        self.__server.daemon_threads = True
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name="profiler", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+        logger.info(f"profiler listening on port {self.__server.server_address[1]}")
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __stacks(self, params):
+        sampler = StackSampler(interval=max(float(params.get("interval", 0.005)), MIN_INTERVAL))
+        return "text/plain", StackSampler.collapse(sampler.sample(self.__seconds(params)))
+
+    def __selectors(self, params):
+        if not self.run_timings:
+            raise LookupError("run timings are not available")
+        self.run_timings.start()
+        try:
+            time.sleep(self.__seconds(params))
+        finally:
+            table = self.run_timings.stop()
+        if params.get("format") == "json":
+            return "application/json", json.dumps(table)
+        lines = [f"{'selector':<32} {'count':>10} {'total_s':>10} {'mean_ms':>10} {'max_ms':>10}"]
+        for selector, row in table.items():
+            lines.append(f"{selector:<32} {row['count']:>10} {row['total_s']:>10.3f} {row['mean_ms']:>10.3f} {row['max_ms']:>10.3f}")
+        return "text/plain", "\n".join(lines) + "\n"
+
+    def __allocations(self, params):
+        lines = top_allocations(self.__seconds(params), int(params.get("limit", 25)), int(params.get("frames", 1)))
+        return "text/plain", "\n".join(lines) + "\n"
+
+    @staticmethod
+    def __seconds(params) -> float:
+        return min(max(float(params.get("seconds", 10)), 0), MAX_SECONDS)
+
+    def handle(self, path: str) -> typing.Tuple[int, str, str]:
+        url = urllib.parse.urlparse(path)
+        params = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+        endpoints = {"/stacks": self.__stacks, "/selectors": self.__selectors, "/allocations": self.__allocations}
+        endpoint = endpoints.get(url.path)
+        if endpoint is None:
+            return 404, "text/plain", "endpoints: " + ", ".join(endpoints) + "\n"
+        if not self.__session.acquire(blocking=False):
+            return 409, "text/plain", "another profiling session is running\n"
+        try:
+            content_type, body = endpoint(params)
+            return 200, content_type, body
+        except (ValueError, LookupError) as ex:
+            return 400, "text/plain", f"{ex}\n"
+        finally:
+            self.__session.release()
+
+    def __gen_handler(self):
+        profiler = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, content_type, body = profiler.handle(self.path)
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(f"profiler: {format % args}")
+
+        return Handler
@@ -0,0 +1,340 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("ReplayMessage", "ReplayConsumer", "ReplayProducer", "ReplayReport", "replay", "read_jsonl", "generate_messages")
+
+from .logger import logger
+from .model import OperatorConfig, Config
+from .metrics import OperatorMetrics
+from .op_base import OperatorBase
+from . import codec
+import confluent_kafka
+import confluent_kafka.admin
+import collections
+import random
+import time
+import tracemalloc
+import typing
+
+
+class ReplayMessage:
+    # in-memory stand-in for confluent_kafka.Message
+    __slots__ = ("__value", "__topic", "__offset", "__timestamp")
+
+    def __init__(self, value: bytes, topic: str, offset: int, timestamp: int):
+        self.__value = value
+        self.__topic = topic
+        self.__offset = offset
+        self.__timestamp = timestamp
+
+    def value(self):
+        return self.__value
+
+    def key(self):
+        return None
+
+    def headers(self):
+        return None
+
+    def error(self):
+        return None
+
+    def topic(self):
+        return self.__topic
+
+    def partition(self):
+        return 0
+
+    def offset(self):
+        return self.__offset
+
+    def timestamp(self):
+        return confluent_kafka.TIMESTAMP_CREATE_TIME, self.__timestamp
+
+
+class ReplayConsumer:
+    """
+    In-memory stand-in for confluent_kafka.Consumer, hands out the given messages without waiting and calls on_end
+    once all were consumed. The latency of a message is the time from handing it out until the next poll or consume
+    call, i.e. until the operator loop finished processing it on the consumer thread.
+    """
+
+    def __init__(self, messages: typing.Sequence[ReplayMessage], on_end: typing.Callable):
+        self.__messages = messages
+        self.__position = 0
+        self.__on_end = on_end
+        self.__paused = False
+        self.__handed_out = 0
+        self.__handed_out_at = 0.0
+        self.latencies: typing.List[float] = list()
+        self.commits = 0
+
+    def __settle(self):
+        if self.__handed_out:
+            latency = time.perf_counter() - self.__handed_out_at
+            self.latencies.extend([latency] * self.__handed_out)
+            self.__handed_out = 0
+
+    def __take(self, count: int) -> typing.Sequence[ReplayMessage]:
+        self.__settle()
+        if self.__paused:
+            return ()
+        messages = self.__messages[self.__position:self.__position + count]
+        self.__position += len(messages)
+        if not messages:
+            self.__on_end()
+        self.__handed_out = len(messages)
+        self.__handed_out_at = time.perf_counter()
+        return messages
+
+    def poll(self, timeout=None):
+        messages = self.__take(1)
+        return messages[0] if messages else None
+
+    def consume(self, num_messages=1, timeout=-1):
+        return list(self.__take(num_messages))
+
+    def subscribe(self, topics, **kwargs):
+        pass
+
+    def assignment(self):
+        return [confluent_kafka.TopicPartition(topic, 0) for topic in {message.topic() for message in self.__messages}]
+
+    def pause(self, partitions):
+        self.__paused = True
+
+    def resume(self, partitions):
+        self.__paused = False
+
+    def store_offsets(self, *args, **kwargs):
+        pass
+
+    def commit(self, *args, **kwargs):
+        self.commits += 1
+
+    def close(self):
+        pass
+
+
+class ReplayProducer:
+    """
+    In-memory stand-in for confluent_kafka.Producer, counts produced records and reports them as delivered on poll.
+    """
+
+    def __init__(self, keep: bool = False):
+        self.__keep = keep
+        self.__callbacks = list()
+        self.records = list()
+        self.count = 0
+        self.bytes = 0
+
+    def produce(self, topic, value=None, key=None, partition=-1, on_delivery=None, **kwargs):
+        self.count += 1
+        self.bytes += len(value)
+        if self.__keep:
+            self.records.append((topic, key, value))
+        if on_delivery:
+            self.__callbacks.append(on_delivery)
+
+    def poll(self, timeout=None):
+        callbacks = self.__callbacks
+        self.__callbacks = list()
+        for callback in callbacks:
+            callback(None, None)
+        return len(callbacks)
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+    def list_topics(self, topic=None, timeout=None):
+        metadata = confluent_kafka.admin.ClusterMetadata()
+        topic_metadata = confluent_kafka.admin.TopicMetadata()
+        topic_metadata.partitions = {0: confluent_kafka.admin.PartitionMetadata()}
+        metadata.topics = {topic: topic_metadata}
+        return metadata
+
+    def __len__(self):
+        return len(self.__callbacks)
+
+
+class RecordingMetrics(OperatorMetrics):
+    # times every message and keeps the raw durations, optionally the allocation peak of every stage
+    def __init__(self, allocations: bool):
+        import prometheus_client
+        super().__init__(sample_rate=1, registry=prometheus_client.CollectorRegistry())
+        self.durations: typing.Dict[str, typing.List[float]] = collections.defaultdict(list)
+        self.allocations: typing.Dict[str, typing.List[int]] = collections.defaultdict(list)
+        self.__allocations = allocations
+        self.__baseline = 0
+
+    def __record_allocation(self, stage: str):
+        current, peak = tracemalloc.get_traced_memory()
+        self.allocations[stage].append(max(peak - self.__baseline, 0))
+        tracemalloc.reset_peak()
+        self.__baseline = current
+
+    def observe(self, stage: str, duration: float):
+        self.durations[stage].append(duration)
+        if self.__allocations:
+            self.__record_allocation(stage)
+
+    def observe_run(self, selector: str, duration: float):
+        stage = f"run:{selector}"
+        self.durations[stage].append(duration)
+        if self.__allocations:
+            self.__record_allocation(stage)
+
+
+def percentile(values: typing.Sequence[float], q: float) -> float:
+    # nearest rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[min(int(q / 100 * len(values)), len(values) - 1)]
+
+
+class ReplayReport(typing.NamedTuple):
+    messages: int
+    results: int
+    seconds: float
+    latency_p50: float
+    latency_p99: float
+    stages: typing.Dict[str, typing.Tuple[int, float, float]] # count, p50 and p99 duration in seconds
+    allocations: typing.Dict[str, float] # mean peak bytes allocated per stage, empty unless measured
+
+    @property
+    def throughput(self) -> float:
+        return self.messages / self.seconds if self.seconds else 0.0
+
+    def format(self) -> str:
+        lines = [
+            f"messages: {self.messages}, results: {self.results}, seconds: {self.seconds:.3f}",
+            f"throughput: {self.throughput:.0f} messages/s",
+            f"latency: p50 {self.latency_p50 * 1e6:.1f} us, p99 {self.latency_p99 * 1e6:.1f} us",
+            f"{'stage':<24} {'count':>10} {'p50_us':>10} {'p99_us':>10} {'alloc_b':>10}"
+        ]
+        for stage, (count, p50, p99) in self.stages.items():
+            allocation = f"{self.allocations[stage]:.0f}" if stage in self.allocations else "-"
+            lines.append(f"{stage:<24} {count:>10} {p50 * 1e6:>10.1f} {p99 * 1e6:>10.1f} {allocation:>10}")
+        return "\n".join(lines)
+
+
+def read_jsonl(path: str, topic: str = "replay") -> typing.List[ReplayMessage]:
+    """
+    Reads one message value per line, e.g. recorded with kafka-console-consumer.
+    """
+    messages = list()
+    timestamp = int(time.time() * 1000)
+    with open(path, "rb") as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                messages.append(ReplayMessage(line, topic, len(messages), timestamp + len(messages)))
+    return messages
+
+
+def set_path(message: typing.Dict, path: str, value):
+    keys = path.split(".")
+    for key in keys[:-1]:
+        message = message.setdefault(key, dict())
+    message[keys[-1]] = value
+
+
+def generate_messages(operator_config: OperatorConfig, count: int, seed: int = 0) -> typing.List[ReplayMessage]:
+    """
+    Generates messages matching the input topics of the operator config, cycling through all filter values.
+    Mapped fields get random numbers.
+    """
+    rnd = random.Random(seed)
+    sources = list()
+    for input_topic in operator_config.inputTopics:
+        for filter_value in input_topic.filterValue.split(","):
+            sources.append((input_topic, filter_value))
+    timestamp = int(time.time() * 1000)
+    messages = list()
+    for number in range(count):
+        input_topic, filter_value = sources[number % len(sources)]
+        if input_topic.filterType == "DeviceId":
+            message = {"device_id": filter_value, "service_id": input_topic.name.replace("_", ":")}
+            prefix = ""
+        elif input_topic.filterType == "OperatorId":
+            operator_id, _, pipeline_id = filter_value.partition(":")
+            message = {"operator_id": operator_id, "pipeline_id": pipeline_id or "replay"}
+            prefix = "analytics."
+        else:
+            message = {"import_id": filter_value}
+            prefix = ""
+        for mapping in input_topic.mappings:
+            set_path(message, prefix + mapping.source, rnd.random() * 100)
+        messages.append(ReplayMessage(codec.dumps(message), input_topic.name, number, timestamp + number))
+    return messages
+
+
+def replay(
+    operator: OperatorBase,
+    operator_config: OperatorConfig,
+    messages: typing.Sequence[ReplayMessage],
+    allocations: bool = False,
+    config: typing.Optional[Config] = None,
+    **init_kwargs
+) -> ReplayReport:
+    """
+    Runs the messages through a real operator and filter handler as fast as possible.
+    :param operator: Operator instance, must not have been initialized yet.
+    :param allocations: Trace allocations per stage, this slows down processing considerably.
+    :param init_kwargs: Further arguments for operator.init, e.g. batch_size or executor_workers.
+    """
+    from . import create_filter_handler
+    filter_handler = create_filter_handler(operator_config.inputTopics, "replay", operator.selectors)
+    metrics = RecordingMetrics(allocations)
+    consumer = ReplayConsumer(messages, on_end=operator.stop)
+    producer = ReplayProducer()
+    operator.init(
+        kafka_consumer=consumer,
+        kafka_producer=producer,
+        filter_handler=filter_handler,
+        output_topic="replay-output",
+        pipeline_id="replay",
+        operator_id="replay",
+        poll_timeout=0,
+        config=config or operator.configType({}),
+        metrics=metrics,
+        **init_kwargs
+    )
+    if allocations:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        operator.start()
+    finally:
+        seconds = time.perf_counter() - start
+        if allocations:
+            tracemalloc.stop()
+    logger.debug(f"replayed {len(messages)} messages in {seconds:.3f}s")
+    latencies = sorted(consumer.latencies)
+    stages = dict()
+    for stage, durations in metrics.durations.items():
+        durations = sorted(durations)
+        stages[stage] = (len(durations), percentile(durations, 50), percentile(durations, 99))
+    return ReplayReport(
+        messages=len(messages),
+        results=producer.count,
+        seconds=seconds,
+        latency_p50=percentile(latencies, 50),
+        latency_p99=percentile(latencies, 99),
+        stages=stages,
+        allocations={stage: sum(values) / len(values) for stage, values in metrics.allocations.items() if values}
+    )
@@ -0,0 +1,141 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("StateStore", "SQLiteStateStore", "get_state_store")
+
+import abc
+import os
+import pickle
+import sqlite3
+import threading
+import typing
+
+STATE_STORE_FILE_NAME = "state.sqlite3"
+
+DELETED = object()
+
+
+class StateStore(abc.ABC):
+    """
+    Key value store for operator state. Values are pickled by put, get returns a copy.
+    put and delete are buffered and become visible to get immediately, commit persists all of them atomically.
+    """
+
+    @abc.abstractmethod
+    def get(self, key: str, default=None):
+        pass
+
+    @abc.abstractmethod
+    def get_prefix(self, prefix: str) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+        pass
+
+    @abc.abstractmethod
+    def put(self, key: str, value):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abc.abstractmethod
+    def commit(self):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Embedded state store in a single SQLite database in WAL mode.
+    Safe to use from several threads, each process must open its own instance.
+    """
+
+    def __init__(self, path: str):
+        self.__lock = threading.Lock()
+        self.__pending: typing.Dict[str, typing.Any] = dict()
+        self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def get(self, key: str, default=None):
+        with self.__lock:
+            if key in self.__pending:
+                value = self.__pending[key]
+                if value is DELETED:
+                    return default
+            else:
+                row = self.__connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return default
+                value = row[0]
+        return pickle.loads(value)
+
+    def get_prefix(self, prefix: str) -> typing.Iterator[typing.Tuple[str, typing.Any]]:
+        # committed values only, the range condition allows the primary key index to be used
+        # rows are fetched at once, the connection must not be used by other threads while a cursor is iterated
+        with self.__lock:
+            rows = self.__connection.execute(
+                "SELECT key, value FROM state WHERE key >= ? AND key < ? ORDER BY key", (prefix, prefix + "\uffff")
+            ).fetchall()
+        for key, value in rows:
+            yield key, pickle.loads(value)
+
+    def put(self, key: str, value):
+        # pickled right away, so an unpicklable value fails here instead of every later commit
+        value = pickle.dumps(value)
+        with self.__lock:
+            self.__pending[key] = value
+
+    def delete(self, key: str):
+        with self.__lock:
+            self.__pending[key] = DELETED
+
+    def commit(self):
+        with self.__lock:
+            if not self.__pending:
+                return
+            upserts = [(key, value) for key, value in self.__pending.items() if value is not DELETED]
+            deletes = [(key,) for key, value in self.__pending.items() if value is DELETED]
+            with self.__connection:
+                self.__connection.execute("BEGIN")
+                if upserts:
+                    self.__connection.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", upserts)
+                if deletes:
+                    self.__connection.executemany("DELETE FROM state WHERE key = ?", deletes)
+            self.__pending.clear()
+
+    def close(self):
+        self.commit()
+        self.__connection.close()
+
+
+stores: typing.Dict[typing.Tuple[int, str], StateStore] = dict()
+stores_lock = threading.Lock()
+
+
+def get_state_store(data_path: str) -> StateStore:
+    """
+    :return: Shared state store of data_path, opened once per process.
+    """
+    key = (os.getpid(), os.path.abspath(data_path))
+    with stores_lock:
+        if key not in stores:
+            os.makedirs(data_path, exist_ok=True)
+            stores[key] = SQLiteStateStore(os.path.join(data_path, STATE_STORE_FILE_NAME))
+        return stores[key]
@@ -1,14 +1,19 @@
 import pandas as pd
+import numpy as np
+import datetime
 import re
 
-__all__ = ("todatetime", "timestamp_to_str", "get_ts_format_from_str")
+__all__ = ("todatetime", "todatetime_many", "timestamp_to_str", "get_ts_format_from_str", "FormatDetector")
+
+INT64_MAX = np.iinfo(np.int64).max
 
 def todatetime(timestamp):
-    if str(timestamp).isdigit():
-        if len(str(timestamp))==13:
-            timestamp = pd.to_datetime(int(timestamp), unit='ms')
-        elif len(str(timestamp))==19:
-            timestamp = pd.to_datetime(int(timestamp), unit='ns')
+    ts_str = str(timestamp)
+    if ts_str.isdigit():
+        if len(ts_str)==13:
+            timestamp = pd.to_datetime(int(ts_str), unit='ms')
+        elif len(ts_str)==19:
+            timestamp = pd.to_datetime(int(ts_str), unit='ns')
     else:
         timestamp = pd.to_datetime(timestamp)
 
@@ -20,11 +25,60 @@ def todatetime(timestamp):
 
     return timestamp
 
-def timestamp_to_str(timestamp): # timestamp is supposed to be a pandas timestamp here!
-    if "." not in timestamp.tz_localize(None).isoformat():# Ensure that the string format of the timestamp is always %Y-%m-%dT%H:%M:%S.%fZ
-        return timestamp.tz_localize(None).isoformat()+".000Z"
+def todatetime_many(timestamps, format="ISO8601") -> pd.DatetimeIndex:
+    # Bulk version of todatetime with a single pd.to_datetime call per kind of input, returns UTC timestamps.
+    # Epoch values with 13 digits are read as milliseconds, with 19 digits as nanoseconds, other numbers and nulls
+    # become NaT. Floats are epochs if they are integral, e.g. integers of a column with gaps.
+    # Strings are parsed as ISO 8601 by default, if that fails the format of every string is inferred separately.
+    # Strings of one stream usually share a format, pass it as format to skip the fallback.
+    values = pd.Series(timestamps)
+    result = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns, UTC]")
+    if pd.api.types.is_integer_dtype(values):
+        ms = (values >= 10**12) & (values < 10**13)
+        ns = (values >= 10**18) & (values <= INT64_MAX)
+        other = None
+    elif pd.api.types.is_float_dtype(values):
+        # e.g. integers with gaps, only integral values are epochs
+        integral = values.notna() & (values % 1 == 0)
+        ms = integral & (values >= 10**12) & (values < 10**13)
+        ns = integral & (values >= 10**18) & (values < 2**63)
+        values = values.where(ms | ns, 0).astype(np.int64)
+        other = None
+    elif pd.api.types.is_numeric_dtype(values):
+        # booleans are not supported
+        return pd.DatetimeIndex(result)
     else:
+        strings = values.astype(str)
+        digits = strings.str.isdigit()
+        lengths = strings.str.len()
+        ms = digits & (lengths == 13)
+        # digit strings of equal length compare like their numbers
+        ns = digits & (lengths == 19) & (strings <= str(INT64_MAX))
+        other = ~digits & values.map(lambda value: isinstance(value, (str, datetime.datetime)))
+        values = strings.where(ms | ns, "0").astype(np.int64)
+    if ms.any():
+        result[ms] = pd.to_datetime(values[ms], unit="ms", utc=True)
+    if ns.any():
+        result[ns] = pd.to_datetime(values[ns], unit="ns", utc=True)
+    if other is not None and other.any():
+        try:
+            result[other] = pd.to_datetime(strings[other], utc=True, format=format)
+        except ValueError:
+            if format != "ISO8601":
+                raise
+            result[other] = pd.to_datetime(strings[other], utc=True, format="mixed")
+    return pd.DatetimeIndex(result)
+
+def timestamp_to_str(timestamp): # timestamp is supposed to be a pandas timestamp or a datetime here!
+    # Ensure that the string format of the timestamp is always %Y-%m-%dT%H:%M:%S.%fZ
+    # A timezone is dropped without conversion. Formatting uses the C implementation of datetime.isoformat,
+    # only timestamps with nanoseconds need pandas.
+    if getattr(timestamp, "nanosecond", 0):
         return timestamp.tz_localize(None).isoformat()+"Z"
+    iso = datetime.datetime.isoformat(timestamp, timespec="seconds")[:19]
+    if timestamp.microsecond:
+        return f"{iso}.{timestamp.microsecond:06d}Z"
+    return iso+".000Z"
 
 DATETIME_FORMATS = [
     ("yyyy-MM-ddTHH:mm:ss.SSSZ", "^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{3}Z$"), #2023-06-01T12:34:56.789Z
@@ -42,8 +96,35 @@ DATETIME_FORMATS = [
     ("Day, dd Mon yyyy HH:mm:ss Z", "^\w{3}, \d{2} \w{3} \d{4} \d{2}:\d{2}:\d{2} [+-]\d{4}$") #Wed, 01 Jun 2023 12:34:56 +0000
 ]
 
+DATETIME_PATTERNS = [(format, re.compile(pattern)) for format, pattern in DATETIME_FORMATS]
+
+UNIX_PATTERN = ("unix", re.compile(r"^\d+$"))
+
 def get_ts_format_from_str(ts):
-    for format in DATETIME_FORMATS:
-        if bool(re.search(format[1], ts)):
-            return format[0]
-    return "unix"
\ No newline at end of file
+    for format, pattern in DATETIME_PATTERNS:
+        if pattern.search(ts):
+            return format
+    return "unix"
+
+class FormatDetector:
+    # Detects the timestamp format of each source once and caches it.
+    # Later values of a source are only checked against the cached pattern, a mismatch triggers a new detection.
+    # Integers are epoch values and skip pattern matching completely, digit strings are detected as epochs upfront.
+
+    def __init__(self):
+        self.__formats = dict()
+
+    def detect(self, source, ts) -> str:
+        if isinstance(ts, (int, np.integer)):
+            return "unix"
+        cached = self.__formats.get(source)
+        if cached and cached[1].search(ts):
+            return cached[0]
+        if ts.isdigit():
+            self.__formats[source] = UNIX_PATTERN
+            return "unix"
+        for format, pattern in DATETIME_PATTERNS:
+            if pattern.search(ts):
+                self.__formats[source] = (format, pattern)
+                return format
+        return "unix"
\ No newline at end of file
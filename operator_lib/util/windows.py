@@ -0,0 +1,275 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("WindowStats", "WindowEngine", "WINDOW_TUMBLING", "WINDOW_SLIDING", "WINDOW_SESSION")
+
+from .persistence import load, save
+from .logger import logger
+import collections
+import datetime
+import math
+import time
+import typing
+
+import numpy as np
+
+WINDOW_TUMBLING = "tumbling" # fixed, non overlapping windows aligned to multiples of size
+WINDOW_SLIDING = "sliding" # covers the last size seconds up to the latest record
+WINDOW_SESSION = "session" # closes once no record arrived for gap seconds
+
+
+class WindowStats(typing.NamedTuple):
+    start: float
+    end: float
+    count: int
+    sum: float
+    min: float
+    max: float
+    mean: float
+    variance: float
+
+
+class Accumulator:
+    # running statistics, variance via Welford's algorithm so values can be removed again for sliding windows
+    __slots__ = ("start", "end", "count", "sum", "mean", "m2", "min", "max")
+
+    def __init__(self, start: float):
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, ts: float, value: float):
+        self.count += 1
+        self.sum += value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if ts > self.end:
+            self.end = ts
+
+    def remove(self, value: float):
+        self.count -= 1
+        self.sum -= value
+        if self.count == 0:
+            self.mean = 0.0
+            self.m2 = 0.0
+            return
+        delta = value - self.mean
+        self.mean -= delta / self.count
+        self.m2 = max(self.m2 - delta * (value - self.mean), 0.0)
+
+    def stats(self) -> WindowStats:
+        return WindowStats(
+            start=self.start,
+            end=self.end,
+            count=self.count,
+            sum=self.sum,
+            min=self.min,
+            max=self.max,
+            mean=self.mean,
+            variance=self.m2 / self.count if self.count else 0.0
+        )
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class SlidingState:
+    # values of the window in array backed ring buffers, min and max via monotonic queues (amortized O(1))
+    __slots__ = ("timestamps", "values", "head", "size", "acc", "min_queue", "max_queue")
+
+    def __init__(self, capacity: int = 64):
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        self.values = np.empty(capacity, dtype=np.float64)
+        self.head = 0
+        self.size = 0
+        self.acc = Accumulator(-math.inf)
+        self.min_queue = collections.deque()
+        self.max_queue = collections.deque()
+
+    def __grow(self):
+        order = (self.head + np.arange(self.size)) % len(self.values)
+        self.timestamps = np.concatenate((self.timestamps[order], np.empty(self.size, dtype=np.float64)))
+        self.values = np.concatenate((self.values[order], np.empty(self.size, dtype=np.float64)))
+        self.head = 0
+
+    def add(self, ts: float, value: float, size: float):
+        # eviction relies on ascending timestamps, a late record counts as arriving with the newest timestamp
+        # and is dropped if it is already outside of the window
+        if self.size:
+            newest = self.acc.end
+            if ts < newest:
+                if ts <= newest - size:
+                    return
+                ts = newest
+        if self.size == len(self.values):
+            self.__grow()
+        tail = (self.head + self.size) % len(self.values)
+        self.timestamps[tail] = ts
+        self.values[tail] = value
+        self.size += 1
+        self.acc.add(ts, value)
+        while self.min_queue and self.min_queue[-1][1] >= value:
+            self.min_queue.pop()
+        self.min_queue.append((ts, value))
+        while self.max_queue and self.max_queue[-1][1] <= value:
+            self.max_queue.pop()
+        self.max_queue.append((ts, value))
+        start = ts - size
+        capacity = len(self.values)
+        while self.size and self.timestamps[self.head] <= start:
+            self.acc.remove(float(self.values[self.head]))
+            self.head = (self.head + 1) % capacity
+            self.size -= 1
+        while self.min_queue[0][0] <= start:
+            self.min_queue.popleft()
+        while self.max_queue[0][0] <= start:
+            self.max_queue.popleft()
+        self.acc.start = float(self.timestamps[self.head])
+        self.acc.min = self.min_queue[0][1]
+        self.acc.max = self.max_queue[0][1]
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+
+class WindowEngine:
+    """
+    Incremental window aggregation keyed by device ID and selector, O(1) per record.
+    Timestamps are datetimes or seconds since epoch, size and gap are seconds, e.g. float(DeploymentConfig.window_time).
+    With data_path the window state is checkpointed via util.persistence at most every checkpoint_interval seconds
+    and restored on creation, so a restart does not need to replay history.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        size: float,
+        gap: typing.Optional[float] = None,
+        on_close: typing.Optional[typing.Callable[[str, str, WindowStats], None]] = None,
+        data_path: typing.Optional[str] = None,
+        checkpoint_name: str = "windows.pickle",
+        checkpoint_interval: float = 60
+    ):
+        """
+        :param gap: Inactivity gap closing a session window, required for session windows.
+        :param on_close: Called with device ID, selector and final stats whenever a tumbling or session window closes.
+        """
+        if kind not in (WINDOW_TUMBLING, WINDOW_SLIDING, WINDOW_SESSION):
+            raise ValueError(f"unknown window kind '{kind}'")
+        if kind == WINDOW_SESSION and (gap is None or gap <= 0):
+            raise ValueError("session windows require a positive gap")
+        if kind != WINDOW_SESSION and size <= 0:
+            raise ValueError("window size must be positive")
+        self.kind = kind
+        self.size = size
+        self.gap = gap
+        self.on_close = on_close
+        self.data_path = data_path
+        self.checkpoint_name = checkpoint_name
+        self.checkpoint_interval = checkpoint_interval
+        self.__last_checkpoint = time.monotonic()
+        self.__windows: typing.Dict[typing.Tuple[str, str], typing.Any] = dict()
+        if data_path:
+            self.__windows = load(data_path, checkpoint_name, dict())
+            logger.debug(f"restored {len(self.__windows)} windows")
+
+    def __close(self, key, acc: Accumulator):
+        if self.on_close and acc.count:
+            self.on_close(key[0], key[1], acc.stats())
+
+    def update(self, device_id: str, selector: str, timestamp, value: float) -> WindowStats:
+        """
+        Adds a record to the window of device and selector.
+        :return: Stats of the current window including the record.
+        """
+        ts = timestamp.timestamp() if isinstance(timestamp, datetime.datetime) else float(timestamp)
+        key = (device_id, selector)
+        window = self.__windows.get(key)
+        if self.kind == WINDOW_SLIDING:
+            if window is None:
+                window = self.__windows[key] = SlidingState()
+            window.add(ts, value, self.size)
+            acc = window.acc
+        else:
+            if self.kind == WINDOW_TUMBLING:
+                start = ts - ts % self.size
+                expired = window is not None and start > window.start
+            else:
+                start = ts
+                expired = window is not None and ts - window.end > self.gap
+            if expired:
+                self.__close(key, window)
+            if window is None or expired:
+                window = self.__windows[key] = Accumulator(start)
+            window.add(ts, value)
+            if value < window.min:
+                window.min = value
+            if value > window.max:
+                window.max = value
+            acc = window
+        if self.data_path and time.monotonic() - self.__last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+        return acc.stats()
+
+    def expire(self, now=None) -> int:
+        """
+        Closes tumbling windows whose end passed and sessions idle for more than gap, and forgets sliding windows
+        without records in the last size seconds. Should be called regularly, e.g. from run, so windows of devices
+        that stopped sending are closed and dropped.
+        :param now: Current time as datetime or seconds since epoch, defaults to the system time. Pass the latest
+        record timestamp instead if records are not timestamped with the current time.
+        :return: Number of dropped windows.
+        """
+        if now is None:
+            now = time.time()
+        elif isinstance(now, datetime.datetime):
+            now = now.timestamp()
+        if self.kind == WINDOW_TUMBLING:
+            expired = [key for key, window in self.__windows.items() if now >= window.start + self.size]
+        elif self.kind == WINDOW_SESSION:
+            expired = [key for key, window in self.__windows.items() if now - window.end > self.gap]
+        else:
+            expired = [key for key, window in self.__windows.items() if window.acc.end <= now - self.size]
+        for key in expired:
+            window = self.__windows.pop(key)
+            if self.kind != WINDOW_SLIDING:
+                self.__close(key, window)
+        return len(expired)
+
+    def get(self, device_id: str, selector: str) -> typing.Optional[WindowStats]:
+        window = self.__windows.get((device_id, selector))
+        if window is None:
+            return None
+        return (window.acc if isinstance(window, SlidingState) else window).stats()
+
+    def checkpoint(self):
+        self.__last_checkpoint = time.monotonic()
+        if self.data_path:
+            save(self.data_path, self.checkpoint_name, self.__windows)
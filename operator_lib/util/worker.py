@@ -0,0 +1,60 @@
+"""
+   Copyright 2024 InfAI (CC SES)
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+__all__ = ("Worker",)
+
+from .logger import logger
+import multiprocessing
+import typing
+
+mp_context = multiprocessing.get_context("fork")
+
+
+class Worker:
+    """
+    Runs target in a forked child process. Meant to be supervised by a watchdog:
+    is_alive restarts a child that died unless the worker was stopped.
+    """
+
+    def __init__(self, number: int, target: typing.Callable, on_death: typing.Optional[typing.Callable[[int], None]] = None):
+        self.number = number
+        self.__target = target
+        self.__on_death = on_death
+        self.__process = None
+        self.__stop = False
+
+    def start(self):
+        self.__process = mp_context.Process(target=self.__target, name=f"worker-{self.number}")
+        self.__process.start()
+        logger.info(f"started worker {self.number} with pid {self.__process.pid}")
+
+    def is_alive(self) -> bool:
+        if self.__stop or self.__process.is_alive():
+            return True
+        logger.error(f"worker {self.number} with pid {self.__process.pid} died with exit code {self.__process.exitcode}, restarting")
+        if self.__on_death:
+            self.__on_death(self.__process.pid)
+        self.start()
+        return True
+
+    def stop(self):
+        self.__stop = True
+        if self.__process and self.__process.is_alive():
+            self.__process.terminate()
+
+    def join(self):
+        if self.__process:
+            self.__process.join()
@@ -51,6 +51,11 @@ setuptools.setup(
         'model_trainer_client @ git+https://github.com/SENERGY-Platform/ml-trainer@v2.0.65#subdirectory=client',
         'mlflow==3.2.0'
     ],
+    extras_require={
+        'orjson': ['orjson'],
+        'msgspec': ['msgspec'],
+        'ujson': ['ujson']
+    },
     packages=setuptools.find_packages(),
     python_requires='>=3.5.3',
     classifiers=(